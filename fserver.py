@@ -52,6 +52,7 @@ else:
 import re
 import tempfile
 import datetime
+import threading
 
 # import these as needed
 #import json
@@ -97,10 +98,96 @@ config.files_url_base = "/fserver-data"
 config.files_dir = base_dir + "/files"
 config.page_dir = base_dir + "/pages"
 
+# the catalog is an index of object data (see "object catalog", below)
+config.catalog_path = config.data_dir + "/catalog.db"
+
+# time limit (in hours) for a request to be completed, after it starts
+# running.  This can be overridden for a board, with the board attribute
+# 'request_timeout_hours', and for tests, with test name patterns here
+# (a matching test pattern takes precedence over the board attribute)
+# A change to a board's time limit applies to its running requests
+# immediately.  A change here applies to running requests after the
+# catalog is rebuilt ('fserver.py --rebuild-catalog').
+config.request_timeout_hours = 12
+config.test_request_timeout_hours = {
+    # "Benchmark.*": 24,
+}
+
+# responses with a text body of at least this size (in bytes) are
+# compressed, if the client accepts gzip or deflate encoding
+config.compress_min_bytes = 1024
+config.compress_level = 6
+
+# number of rows of an object table (e.g. requests or runs) to output
+# before flushing the page output to the client
+config.table_flush_rows = 100
+
+# default and maximum number of results returned by a query action
+# (0 means no limit).  Clients can request fewer with the 'limit' parameter,
+# and get the next results using the returned cursor.  Note that older
+# clients do not handle cursors, so the default is no limit.  The maximum
+# applies to every query, but a query without 'limit' or 'cursor' (with no
+# default limit) fails if it has more results, instead of being cut short.
+config.query_default_limit = 0
+config.query_max_limit = 10000
+
+# default number of rows shown on a page of an object table
+# (a user can select a different page size, with 0 meaning all rows)
+config.table_page_size = 100
+
+# maximum total size (in bytes) of the extracted run directories under
+# files/runs.  A run package is extracted when a file in it is requested,
+# and the least recently used directories are removed when over this size.
+config.run_cache_max_bytes = 2*1024*1024*1024
+
+# maximum time (in seconds) that get_next_request waits for a matching
+# request, and the interval between checks for new requests while waiting
+# (requests put in the same process are noticed immediately)
+config.next_request_max_wait = 60
+config.next_request_poll_interval = 2
+
+# interval (in seconds) between checks for request timeouts, in the
+# background, when running as a persistent server
+config.timeout_check_interval = 60
+
+# durability of object data (json) file writes.  Files are always written
+# to a temporary file and renamed into place, so a crash never leaves a
+# partly written file, but recent writes may be lost unless synced:
+#  "none" - files are not synced (fastest)
+#  "always" - each file is synced to disk before the write completes
+#  "group" - writes made within fsync_group_ms of each other (in the same
+#      server process) are synced together, and wait for that.  This
+#      only batches writes in a persistent server; in CGI mode, it acts
+#      like "always".
+config.fsync_policy = "none"
+config.fsync_group_ms = 10
+
+# interval (in seconds) between compactions of the request journal (see
+# "request journal", below), when running as a persistent server
+# (--serve, or in-process in test-server.py).  When running as a CGI
+# script, 'fserver.py --compact-journal' must be run from cron.
+config.journal_compact_interval = 3600
+
+# the watch action streams changes to clients, for up to watch_max_time
+# seconds (clients then reconnect).  A comment line is sent after
+# watch_heartbeat_interval seconds without changes, and the journal is
+# checked for changes made by other processes every watch_poll_interval
+# seconds (changes made in the same process are sent immediately).
+config.watch_max_time = 3600
+config.watch_heartbeat_interval = 15
+config.watch_poll_interval = 1
+
 class req_class:
     def __init__(self, config):
         self.config = config
+        # CGI environment and input stream for this request
+        # these are replaced when running as a persistent server
+        self.environ = os.environ
+        self.input = sys.stdin
         self.header_shown = False
+        # additional headers for pages (see show_header)
+        self.headers = []
+        self.table_rows = 0
         self.message = ""
         self.page_name = ""
         self.page_url = "page_name_not_set_error"
@@ -158,7 +245,10 @@ class req_class:
 
         self.header_shown = True
 
-        self.header = """Content-type: text/html\n\n"""
+        self.header = "Content-type: text/html\n"
+        for header in self.headers:
+            self.header += "%s: %s\n" % header
+        self.header += "\n"
 
         # render the header markup
         print(self.header)
@@ -208,10 +298,267 @@ def get_timestamp():
     #timestamp += "+" + zone # this doesn't work
     return timestamp
 
-def save_file(req, file_field, upload_dir):
+# Allocate the timestamp for a new request id.
+# Request ids are "request-<timestamp>-<host>:<board>", and must be unique,
+# even when many requests are submitted for a board at once (by
+# different processes).  The timestamp has microsecond resolution, and
+# the last one issued is kept in a state file, so each one is later than
+# the one before (even if the clock goes backwards).  The state file is
+# read and written while holding its lock.
+def allocate_request_timestamp(req):
+    state_path = req.config.data_dir + os.sep + "locks" + os.sep + \
+        "request-id.state"
+    with object_lock(req, state_path):
+        try:
+            last = int(open(state_path).read().strip())
+        except (IOError, ValueError):
+            last = 0
+
+        usecs = int(time.time() * 1000000)
+        if usecs <= last:
+            usecs = last + 1
+
+        # replace the file, so a crash can't leave it empty or partly
+        # written.  It is not synced (which would hold the lock for the
+        # sync): after a crash, the clock is still past the lost value.
+        write_file(req, state_path, "%d\n" % usecs, "none")
+
+    return time.strftime("%Y-%m-%d_%H:%M:%S.",
+        time.gmtime(usecs // 1000000)) + "%06d" % (usecs % 1000000)
+
+# ids have a timestamp from get_timestamp() (older requests) or
+# allocate_request_timestamp()
+request_id_pattern = re.compile(
+    r"^request-(\d{4}-\d\d-\d\d_\d\d:\d\d:\d\d(?:\.\d+)?)-([^:]*):(.*)$")
+
+# split a request id into (timestamp, host, board).
+# Returns None if request_id is not a valid request id.
+def parse_request_id(request_id):
+    m = request_id_pattern.match(request_id)
+    if not m:
+        return None
+    return m.groups()
+
+# form returned by read_upload_form
+# items have a 'value' attribute, like the items in a cgi.FieldStorage
+class upload_form_class:
+    def __init__(self):
+        self.items = {}
+
+    def __getitem__(self, key):
+        return self.items[key]
+
+    def __setitem__(self, key, item):
+        self.items[key] = item
+
+    def has_key(self, key):
+        return self.items.has_key(key)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def keys(self):
+        return self.items.keys()
+
+    def getvalue(self, key, default=None):
+        if key in self.items:
+            return self.items[key].value
+        return default
+
+# file wrapper that computes the SHA-256 digest and size of the data
+# written to it
+class digest_file_class:
+    def __init__(self, fout):
+        import hashlib
+        self.fout = fout
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        self.fout.write(data)
+
+    def close(self):
+        self.fout.close()
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+# read a multipart/form-data upload, from req.input
+# The part for file_field is written directly to a temporary file in
+# upload_dir (instead of being spooled by cgi.FieldStorage and then
+# copied into upload_dir).  Other parts, and the fields in the query
+# string, are put into req.form.  The digest and size of the file are
+# computed as it is written, and saved in req.upload_sha256 and
+# req.upload_size.
+# If use_blobs is set, an existing file of the same name does not stop
+# the upload, and the file part may be missing (in which case temppath
+# is "").
+# Returns (result, msg, filename, temppath)
+def read_upload_form(req, file_field, upload_dir, use_blobs=False):
+    F = "FAIL"
+    req.form = upload_form_class()
+    req.upload_sha256 = ""
+    req.upload_size = 0
+    for key, value in cgi.parse_qsl(req.environ.get("QUERY_STRING", "")):
+        req.form[key] = cgi.MiniFieldStorage(key, value)
+
+    ctype, params = cgi.parse_header(req.environ.get("CONTENT_TYPE", ""))
+    boundary = params.get("boundary", "")
+    if ctype != "multipart/form-data" or not boundary:
+        return F, "Upload is not multipart/form-data\n", "", ""
+
+    try:
+        remaining = int(req.environ.get("CONTENT_LENGTH", ""))
+    except ValueError:
+        return F, "Upload is missing a valid CONTENT_LENGTH\n", "", ""
+
+    # the CRLF before the first delimiter is optional, so supply one
+    delimiter = "\r\n--" + boundary
+    buf = "\r\n"
+    filename = ""
+    temppath = ""
+    fout = None
+    part = None      # list of data for current non-file part
+    part_name = ""
+    done = False
+
+    try:
+        while not done:
+            pos = buf.find(delimiter)
+            if pos < 0:
+                # write out what can't be part of a delimiter
+                keep = len(delimiter) - 1
+                if len(buf) > keep:
+                    if fout:
+                        fout.write(buf[:-keep])
+                    elif part is not None:
+                        part.append(buf[:-keep])
+                    buf = buf[-keep:]
+                if remaining <= 0:
+                    raise ValueError("Upload ended without final boundary")
+                chunk = req.input.read(min(remaining, 65536))
+                if not chunk:
+                    raise ValueError("Upload ended without final boundary")
+                remaining -= len(chunk)
+                buf += chunk
+                continue
+
+            # finish the current part
+            if fout:
+                fout.write(buf[:pos])
+                fout.close()
+                req.upload_sha256 = fout.hexdigest()
+                req.upload_size = fout.size
+                fout = None
+            elif part is not None:
+                part.append(buf[:pos])
+                value = "".join(part)
+                req.form[part_name] = cgi.MiniFieldStorage(part_name, value)
+                part = None
+            buf = buf[pos+len(delimiter):]
+
+            # read the part headers (or the close delimiter)
+            while True:
+                if buf.startswith("--"):
+                    done = True
+                    break
+                header_end = buf.find("\r\n\r\n")
+                if header_end >= 0:
+                    break
+                if len(buf) > 16384 or remaining <= 0:
+                    raise ValueError("Invalid headers in upload")
+                chunk = req.input.read(min(remaining, 65536))
+                if not chunk:
+                    raise ValueError("Upload ended in part headers")
+                remaining -= len(chunk)
+                buf += chunk
+            if done:
+                break
+
+            headers = buf[:header_end].split("\r\n")
+            buf = buf[header_end+4:]
+            disposition = {}
+            for line in headers:
+                if line.lower().startswith("content-disposition:"):
+                    value, disposition = cgi.parse_header(line.split(":", 1)[1])
+            part_name = disposition.get("name", "")
+
+            if part_name == file_field and "filename" in disposition \
+                    and not temppath:
+                filename = os.path.basename(disposition["filename"])
+                if not filename:
+                    raise ValueError("Missing filename for %s" % file_field)
+                if not use_blobs and \
+                        os.path.exists(upload_dir + os.sep + filename):
+                    return F, "Already have a file %s. Cannot proceed.\n" % \
+                        filename, "", ""
+                fd, temppath = tempfile.mkstemp(dir=upload_dir,
+                    prefix=".upload-")
+                fout = digest_file_class(os.fdopen(fd, "wb"))
+            else:
+                part = []
+    except (ValueError, IOError, OSError) as e:
+        if fout:
+            fout.close()
+        if temppath:
+            os.unlink(temppath)
+        return F, "Error reading upload: %s\n" % e, "", ""
+
+    # discard any epilogue
+    while remaining > 0:
+        chunk = req.input.read(min(remaining, 65536))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+
+    if not temppath and not use_blobs:
+        return F, "Form is missing key %s\n" % file_field, "", ""
+
+    return "OK", "", filename, temppath
+
+# return the path of the blob with the given digest in the blob store
+# Package files (.ftp and .ftbp) are hard links to files in the blob
+# store, so identical packages are only stored once.
+def get_blob_path(req, sha256):
+    blob_dir = req.config.files_dir + os.sep + "blobs"
+    return blob_dir + os.sep + sha256[:2] + os.sep + sha256
+
+# put a file into the blob store (as a hard link), unless content with
+# the same digest is already there.  Returns the blob path.
+def store_blob(req, filepath, sha256):
+    blob_path = get_blob_path(req, sha256)
+    if os.path.exists(blob_path):
+        return blob_path
+
+    blob_dir = os.path.dirname(blob_path)
+    if not os.path.isdir(blob_dir):
+        try:
+            os.makedirs(blob_dir)
+        except OSError:
+            # another upload may have made it
+            pass
+    try:
+        os.link(filepath, blob_path)
+    except OSError:
+        if not os.path.exists(blob_path):
+            raise
+    return blob_path
+
+# save an uploaded file from the form into upload_dir
+# If use_blobs is set, the file is stored in the blob store, and linked
+# into upload_dir.  In this case, the client may send just the digest
+# (the 'sha256' and 'filename' fields) of content already on the server,
+# and a repeated upload of the same file is acknowledged as a duplicate
+# (with req.upload_duplicate set).
+def save_file(req, file_field, upload_dir, use_blobs=False):
     # some debugging...
     F = "FAIL"
-    msg = ""
+    req.upload_duplicate = False
+
+    result, msg, filename, temppath = read_upload_form(req, file_field,
+        upload_dir, use_blobs)
 
     if debug:
         log_msg = "DEBUG: req.form=\n"
@@ -219,41 +566,912 @@ def save_file(req, file_field, upload_dir):
             log_msg += "%s: %s\n" % (k, req.form[k])
         log_this(log_msg)
 
-    if not req.form.has_key(file_field):
-        return F, msg+"Form is missing key %s\n" % file_field, ""
+    if result != "OK":
+        return result, msg, ""
+
+    client_sha256 = req.form.getvalue("sha256", "").strip().lower()
+    if not temppath:
+        # no file was sent - use content already in the blob store
+        filename = os.path.basename(req.form.getvalue("filename", ""))
+        if not filename or not client_sha256:
+            return F, msg+"Form is missing key %s\n" % file_field, ""
+        if not re.match("^[0-9a-f]{64}$", client_sha256):
+            return F, msg+"Error: invalid sha256 '%s'\n" % client_sha256, ""
+        blob_path = get_blob_path(req, client_sha256)
+        if not os.path.exists(blob_path):
+            msg += "Error: no stored content with sha256=%s (please upload the file)\n" % client_sha256
+            return F, msg, ""
+        req.upload_sha256 = client_sha256
+        req.upload_size = os.path.getsize(blob_path)
+    elif client_sha256 and client_sha256 != req.upload_sha256:
+        # check the digest supplied by the client
+        os.unlink(temppath)
+        msg += "Error: SHA-256 mismatch for %s (client=%s, server=%s)\n" % \
+            (filename, client_sha256, req.upload_sha256)
+        return F, msg, ""
+    else:
+        os.chmod(temppath, 0644)
 
-    fileitem = req.form[file_field]
-    if not fileitem.file:
-        return F, msg+"fileitem has no attribute 'file'\n", ""
+    filepath = upload_dir + os.sep + filename
+    if use_blobs:
+        if temppath:
+            try:
+                blob_path = store_blob(req, temppath, req.upload_sha256)
+            finally:
+                os.unlink(temppath)
+        src_path = blob_path
+    else:
+        src_path = temppath
 
-    if not fileitem.filename:
-        return F, msg+"fileitem has no attribute 'filename'\n", ""
+    # link the file into place, so an existing file is never replaced
+    try:
+        os.link(src_path, filepath)
+    except OSError:
+        if temppath and not use_blobs:
+            os.unlink(temppath)
+        if use_blobs and os.path.exists(filepath) and \
+                os.path.samefile(filepath, src_path):
+            req.upload_duplicate = True
+            msg += "Already have file %s, with the same content\n" % filename
+            msg += "sha256=%s\n" % req.upload_sha256
+            return "OK", msg, filepath
+        return F, msg+"Already have a file %s. Cannot proceed.\n" % filename, ""
+    if not use_blobs:
+        os.unlink(temppath)
+
+    if temppath:
+        msg += "File '%s' uploaded successfully!\n" % filename
+    else:
+        msg += "File '%s' linked to existing content\n" % filename
+    msg += "sha256=%s\n" % req.upload_sha256
+    msg += "size=%d\n" % req.upload_size
+    return "OK", msg, filepath
 
-    filepath = upload_dir + os.sep +  fileitem.filename
-    if os.path.exists(filepath):
-        return F, msg+"Already have a file %s. Cannot proceed.\n" % fileitem.filename, ""
+# save the digest of an uploaded file, in sha256sum format, with the
+# object's data (at <data_path>.sha256)
+def write_digest_file(req, data_path, filepath):
+    digest_path = data_path + ".sha256"
+    write_file(req, digest_path,
+        "%s  %s\n" % (req.upload_sha256, os.path.basename(filepath)))
+
+# check that a put of a package finished, by checking for its data
+# file (at data_path), and the digest file, which is written last
+def upload_complete(data_path):
+    return os.path.exists(data_path) and \
+        os.path.exists(os.path.splitext(data_path)[0] + ".sha256")
+
+# read a digest file
+# returns (sha256, filename), or ("", "") if not found
+def read_digest_file(digest_path):
+    try:
+        line = open(digest_path).readline()
+        sha256, filename = line.split(None, 1)
+    except (IOError, ValueError):
+        return "", ""
+    return sha256, filename.strip()
+
+# normalize the name of a tar archive member (remove leading './')
+def tar_member_name(name):
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+# extract a single file from a tar archive, into dest_path
+# The archive is read sequentially, and reading stops when the member
+# is found.  Returns an error message, or "" on success.
+def extract_tar_member(tar_path, member_name, dest_path):
+    import tarfile
+    try:
+        tar = tarfile.open(tar_path, "r|*")
+    except (tarfile.TarError, IOError) as e:
+        return "Error: can't read %s as a tar file (%s)\n" % (os.path.basename(tar_path), e)
 
-    fout = open(filepath, 'wb')
-    while 1:
-        chunk = fileitem.file.read(100000)
-        if not chunk:
-            break
-        fout.write(chunk)
-    fout.close()
-    msg += "File '%s' uploaded successfully!\n" % fileitem.filename
-    return "OK", msg, filepath
+    try:
+        try:
+            for info in tar:
+                if tar_member_name(info.name) != member_name:
+                    continue
+                if not info.isfile():
+                    return "Error: %s in %s is not a regular file\n" % \
+                        (member_name, os.path.basename(tar_path))
+
+                src = tar.extractfile(info)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path))
+                fout = os.fdopen(fd, "wb")
+                while 1:
+                    chunk = src.read(100000)
+                    if not chunk:
+                        break
+                    fout.write(chunk)
+                fout.close()
+                os.chmod(tmp_path, 0644)
+                os.rename(tmp_path, dest_path)
+                return ""
+        except (tarfile.TarError, IOError, EOFError) as e:
+            return "Error: reading %s failed (%s)\n" % (os.path.basename(tar_path), e)
+    finally:
+        tar.close()
+
+    return "Error: can't find %s in %s\n" % (member_name, os.path.basename(tar_path))
+
+# extract all files from a tar archive, into dest_dir
+# members with absolute paths, or paths outside dest_dir, and special
+# files (devices and fifos) are not allowed.
+# Returns an error message, or "" on success.
+def extract_tar(tar_path, dest_dir):
+    import tarfile
+    try:
+        tar = tarfile.open(tar_path, "r|*")
+    except (tarfile.TarError, IOError) as e:
+        return "Error: can't read %s as a tar file (%s)\n" % (os.path.basename(tar_path), e)
 
-def send_response(result, data):
-    sys.stdout.write("Content-type: text/html\n\n%s\n" % result)
+    try:
+        try:
+            for info in tar:
+                name = tar_member_name(info.name)
+                if os.path.isabs(name) or ".." in name.split("/"):
+                    return "Error: invalid path %s in %s\n" % \
+                        (info.name, os.path.basename(tar_path))
+                if (info.issym() or info.islnk()) and \
+                        (os.path.isabs(info.linkname) or \
+                        ".." in info.linkname.split("/")):
+                    return "Error: invalid link %s in %s\n" % \
+                        (info.name, os.path.basename(tar_path))
+                if info.isdev():
+                    return "Error: special file %s not allowed in %s\n" % \
+                        (info.name, os.path.basename(tar_path))
+                tar.extract(info, dest_dir)
+        except (tarfile.TarError, IOError, OSError, EOFError) as e:
+            return "Error: extracting %s failed (%s)\n" % (os.path.basename(tar_path), e)
+    finally:
+        tar.close()
+
+    return ""
+
+# return an ETag value for a file, from its modification time and size
+def file_etag(filepath):
+    st = os.stat(filepath)
+    return '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+
+def http_date(t):
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(t))
+
+# send a 304 (Not Modified) response, if the client already has the
+# current version of the data (as indicated by an If-None-Match header
+# with the etag, or an If-Modified-Since header not older than mtime)
+# Otherwise, return the validator headers to send with the data.
+def check_not_modified(req, etag, mtime=None):
+    headers = [("ETag", etag), ("Cache-Control", "no-cache")]
+    if mtime:
+        headers.append(("Last-Modified", http_date(mtime)))
+
+    not_modified = False
+    if_none_match = req.environ.get("HTTP_IF_NONE_MATCH", "")
+    if_modified_since = req.environ.get("HTTP_IF_MODIFIED_SINCE", "")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        not_modified = etag in tags or "W/" + etag in tags or "*" in tags
+    elif if_modified_since and mtime:
+        import email.utils
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since:
+            not_modified = int(mtime) <= email.utils.mktime_tz(since)
+
+    if not_modified:
+        sys.stdout.write("Status: 304 Not Modified\n")
+        for header in headers:
+            sys.stdout.write("%s: %s\n" % header)
+        sys.stdout.write("\n")
+        sys.exit(0)
+
+    return headers
+
+# headers is a list of (name, value) for additional response headers
+def send_response(result, data, headers=None):
+    sys.stdout.write("Content-type: text/html\n")
+    for header in headers or []:
+        sys.stdout.write("%s: %s\n" % header)
+    sys.stdout.write("\n%s\n" % result)
     sys.stdout.write(data)
-    sys.stdout.flush()
     if debug:
         log_this("DEBUG: send_response: %s with msg: '%s'" % (result, data))
     sys.exit(0)
 
+#######################
+# object catalog
+#
+# The catalog is an sqlite database, with an index of the data for
+# requests and runs.  It is used to answer queries, and show object
+# tables, without reading every json file in the data directory.
+#
+# The json files are still the authoritative data (for requests, the
+# request files plus the request journal).  The catalog is updated
+# whenever an object file is written or removed, or a request is changed,
+# and can be rebuilt from the files at any time (with
+# 'fserver.py --rebuild-catalog').
+# It is rebuilt automatically if it is missing, or if CATALOG_VERSION
+# does not match the version of the catalog file.
+
+CATALOG_VERSION = 6
+
+CATALOG_SCHEMA = """
+CREATE TABLE requests (
+    request_id TEXT PRIMARY KEY,
+    host TEXT,
+    board TEXT,
+    state TEXT,
+    requestor TEXT,
+    test_name TEXT,
+    request_time TEXT,
+    deadline TEXT,
+    data TEXT
+);
+CREATE INDEX requests_host_board ON requests(host, board);
+CREATE INDEX requests_state ON requests(state);
+CREATE INDEX requests_requestor ON requests(requestor);
+CREATE INDEX requests_test_name ON requests(test_name);
+CREATE INDEX requests_request_time ON requests(request_time);
+CREATE INDEX requests_deadline ON requests(deadline);
+CREATE TABLE runs (
+    run_id TEXT PRIMARY KEY,
+    name TEXT,
+    status TEXT,
+    host_name TEXT,
+    board TEXT,
+    test_spec TEXT,
+    timestamp TEXT,
+    request_id TEXT,
+    requestor TEXT,
+    error TEXT,
+    metadata TEXT
+);
+CREATE INDEX runs_host_board ON runs(host_name, board);
+CREATE INDEX runs_name ON runs(name);
+CREATE INDEX runs_request_id ON runs(request_id);
+CREATE INDEX runs_requestor ON runs(requestor);
+CREATE INDEX runs_timestamp ON runs(timestamp);
+CREATE TABLE run_cache (
+    run_id TEXT PRIMARY KEY,
+    size INTEGER,
+    last_access REAL
+);
+CREATE INDEX run_cache_last_access ON run_cache(last_access);
+CREATE TABLE meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+CREATE TABLE run_members (
+    run_id TEXT,
+    path TEXT,
+    type TEXT,
+    offset INTEGER,
+    size INTEGER,
+    PRIMARY KEY (run_id, path)
+);
+"""
+
+# request attributes that are indexed in the catalog
+request_index_fields = ["host", "board", "state", "requestor", "test_name",
+        "request_time"]
+
+# run metadata attributes that are indexed in the catalog
+run_index_fields = ["host_name", "board", "test_spec", "timestamp",
+        "request_id", "requestor"]
+
+# one connection per thread (and per process, after a fork)
+catalog_local = threading.local()
+
+def open_catalog(req):
+    db = getattr(catalog_local, "db", None)
+    if db and catalog_local.pid == os.getpid():
+        return db
+
+    import sqlite3
+    db = sqlite3.connect(req.config.catalog_path, timeout=30,
+            isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version != CATALOG_VERSION:
+        rebuild_catalog(req, db)
+
+    catalog_local.db = db
+    catalog_local.pid = os.getpid()
+    return db
+
+def read_json_file(filepath):
+    import json
+    with open(filepath) as fd:
+        return json.load(fd)
+
+# write object data to a json file (beautified)
+def write_json_file(req, filepath, data_dict):
+    import json
+    data = json.dumps(data_dict, sort_keys=True, indent=4, separators=(',', ': '))
+    write_file(req, filepath, data+'\n')
+
+# replace the contents of a file, using a temporary file that is renamed
+# into place, and sync it according to config.fsync_policy (or 'policy',
+# if given)
+def write_file(req, filepath, data, policy=None):
+    if not policy:
+        policy = req.config.fsync_policy
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath))
+    fout = os.fdopen(fd, "w")
+    try:
+        fout.write(data)
+        fout.flush()
+        if policy == "group":
+            group_sync_file(req, fout, tmp_path, filepath)
+        else:
+            if policy == "always":
+                os.fsync(fout.fileno())
+            fout.close()
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, filepath)
+            if policy == "always":
+                sync_dir(os.path.dirname(filepath))
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        # (already closed, unless there was an error)
+        fout.close()
+
+# append data to a file, and sync it according to config.fsync_policy
+# The data is written with a single write, so appends from different
+# processes are not mixed together.
+def append_file(req, filepath, data):
+    policy = req.config.fsync_policy
+    created = not os.path.exists(filepath)
+    fd = os.open(filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, data)
+    except:
+        os.close(fd)
+        raise
+
+    fout = os.fdopen(fd, "a")
+    try:
+        if policy == "group":
+            group_sync_file(req, fout, None, filepath)
+        else:
+            if policy == "always":
+                os.fsync(fd)
+            fout.close()
+            if policy == "always" and created:
+                sync_dir(os.path.dirname(filepath))
+    finally:
+        fout.close()
+
+# sync a directory, so that renames in it are on disk
+def sync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# group commit of file writes (fsync_policy "group")
+# The first writer of a group waits fsync_group_ms for others to join it,
+# then syncs and renames all the files of the group, and syncs their
+# directories once.  The other writers wait for this to finish.
+class fsync_group_class:
+    def __init__(self):
+        # list of (file object, temporary path, final path)
+        # (the temporary path is None for an append)
+        self.files = []
+        self.done = threading.Event()
+        self.error = None
+
+fsync_group_lock = threading.Lock()
+fsync_group = None
+
+def group_sync_file(req, fout, tmp_path, filepath):
+    global fsync_group
+    with fsync_group_lock:
+        group = fsync_group
+        leader = group is None
+        if leader:
+            group = fsync_group = fsync_group_class()
+        group.files.append((fout, tmp_path, filepath))
+
+    if leader:
+        time.sleep(req.config.fsync_group_ms / 1000.0)
+        with fsync_group_lock:
+            fsync_group = None
+        try:
+            dirs = set()
+            for fout, tmp_path, filepath in group.files:
+                os.fsync(fout.fileno())
+                fout.close()
+                if tmp_path:
+                    os.chmod(tmp_path, 0644)
+                    os.rename(tmp_path, filepath)
+                dirs.add(os.path.dirname(filepath))
+            for dir_path in dirs:
+                sync_dir(dir_path)
+        except (IOError, OSError) as e:
+            group.error = e
+        group.done.set()
+    else:
+        group.done.wait()
+
+    if group.error:
+        raise group.error
+
+def rebuild_catalog(req, db, force=False):
+    # lock the catalog, so only one process does the rebuild
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version == CATALOG_VERSION and not force:
+            # someone else just rebuilt it
+            db.execute("COMMIT")
+            return
+
+        tables = db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        for row in tables:
+            db.execute("DROP TABLE %s" % row[0])
+        for statement in CATALOG_SCHEMA.split(";"):
+            if statement.strip():
+                db.execute(statement)
+
+        # start the generation from the time, so it is never reused for
+        # different data after a rebuild
+        db.execute("INSERT INTO meta VALUES ('generation', ?)",
+            (int(time.time() * 1000),))
+
+        req_data_dir = req.config.data_dir + os.sep + "requests"
+        for f in os.listdir(req_data_dir):
+            if not f.endswith(".json") or not parse_request_id(f[:-5]):
+                continue
+            try:
+                req_dict = read_json_file(req_data_dir + os.sep + f)
+            except:
+                log_this("Error: could not read request file %s" % f)
+                continue
+            catalog_put_request(req, f[:-5], req_dict, db)
+
+        # apply the request changes made since the request files were
+        # last compacted
+        for entry, position in read_journal(req, read_checkpoint(req)):
+            if "request_id" not in entry:
+                continue
+            request_id = entry["request_id"]
+            old_dict = catalog_get_request(req, request_id, db)
+            req_dict = apply_journal_entry(old_dict, entry)
+            if req_dict is None:
+                if old_dict is not None:
+                    catalog_remove_request(req, request_id, db)
+            elif req_dict is not old_dict:
+                catalog_put_request(req, request_id, req_dict, db)
+
+        run_data_dir = req.config.data_dir + os.sep + "runs"
+        for f in os.listdir(run_data_dir):
+            if not f.startswith("run-") or not f.endswith(".json"):
+                continue
+            try:
+                run_dict = read_json_file(run_data_dir + os.sep + f)
+            except:
+                log_this("Error: could not read run file %s" % f)
+                run_dict = None
+            catalog_put_run(req, f[:-5], run_dict, db)
+
+        run_file_dir = req.config.files_dir + os.sep + "runs"
+        for f in os.listdir(run_file_dir):
+            if f.startswith("run-") and f.endswith(".frp"):
+                catalog_put_run_members(req, f[:-4],
+                    run_file_dir + os.sep + f, db)
+
+        # record run directories that are already extracted
+        import shutil
+        for f in os.listdir(run_file_dir):
+            run_dir_path = run_file_dir + os.sep + f
+            if not os.path.isdir(run_dir_path):
+                continue
+            if is_run_temp_dir(f):
+                # left by an interrupted extraction (unless it is
+                # still in progress)
+                if time.time() - os.path.getmtime(run_dir_path) > 3600:
+                    shutil.rmtree(run_dir_path, ignore_errors=True)
+                continue
+            if f.startswith("."):
+                continue
+            db.execute("INSERT OR REPLACE INTO run_cache VALUES (?, ?, ?)",
+                ("run-" + f, dir_size(run_dir_path),
+                os.path.getmtime(run_dir_path)))
+
+        db.execute("PRAGMA user_version=%d" % CATALOG_VERSION)
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+def catalog_put_request(req, request_id, req_dict, db=None):
+    import json
+    if not db:
+        db = open_catalog(req)
+
+    # use the id for index fields missing from the request data
+    id_fields = {}
+    id_parts = parse_request_id(request_id)
+    if id_parts:
+        id_fields["request_time"], id_fields["host"], id_fields["board"] = \
+            id_parts
+
+    values = [request_id]
+    for field in request_index_fields:
+        values.append(req_dict.get(field, id_fields.get(field, None)))
+    values.append(request_deadline(req, req_dict))
+    values.append(json.dumps(req_dict, sort_keys=True))
+
+    db.execute("INSERT OR REPLACE INTO requests (request_id, %s, deadline, data) VALUES (%s)" %
+            (", ".join(request_index_fields), ", ".join(["?"] * len(values))),
+            values)
+    catalog_changed(db)
+
+# recompute the deadlines of the running requests for a board, after
+# the board's request time limit may have changed
+def catalog_refresh_deadlines(req, host, board):
+    import json
+    db = open_catalog(req)
+    rows = db.execute("SELECT request_id, data FROM requests WHERE host=? AND board=? AND state='running'",
+            (host, board)).fetchall()
+    for row in rows:
+        deadline = request_deadline(req, json.loads(row["data"]))
+        db.execute("UPDATE requests SET deadline=? WHERE request_id=?",
+            (deadline, row["request_id"]))
+
+def catalog_remove_request(req, request_id, db=None):
+    if not db:
+        db = open_catalog(req)
+    db.execute("DELETE FROM requests WHERE request_id=?", (request_id,))
+    catalog_changed(db)
+
+# return the current data of a request, or None if there is no such request
+def catalog_get_request(req, request_id, db=None):
+    import json
+    if not db:
+        db = open_catalog(req)
+    row = db.execute("SELECT data FROM requests WHERE request_id=?",
+        (request_id,)).fetchone()
+    if not row:
+        return None
+    return json.loads(row["data"])
+
+# the catalog generation is changed whenever request or run data is
+# changed.  It is used as the ETag of object tables.
+def catalog_changed(db):
+    db.execute("UPDATE meta SET value=value+1 WHERE name='generation'")
+
+def catalog_generation(req):
+    db = open_catalog(req)
+    return db.execute("SELECT value FROM meta WHERE name='generation'").fetchone()[0]
+
+# add a run to the catalog
+# run_dict is the data from the run's json file (or None, if the
+# file could not be read)
+def catalog_put_run(req, run_id, run_dict, db=None):
+    import json
+    if not db:
+        db = open_catalog(req)
+
+    error = ""
+    name = None
+    status = None
+    metadata = {}
+    if run_dict is None:
+        error = "Read"
+    else:
+        if "name" in run_dict:
+            name = run_dict["name"]
+        elif "test_name" in run_dict:
+            # this is here because older versions of the Fuego core
+            # created a pre-run run.json file with 'test_name' instead
+            # of 'name'.
+            name = run_dict["test_name"]
+        else:
+            error = "Data"
+        status = run_dict.get("status", None)
+        metadata = run_dict.get("metadata", {})
+        for field in ["test_spec", "host_name", "board", "timestamp"]:
+            if field not in metadata:
+                error = "Data"
+        if status is None:
+            error = "Data"
+
+    values = [run_id, name, status]
+    for field in run_index_fields:
+        values.append(metadata.get(field, None))
+    values.append(error)
+    values.append(json.dumps(metadata, sort_keys=True))
+
+    db.execute("INSERT OR REPLACE INTO runs (run_id, name, status, %s, error, metadata) VALUES (%s)" %
+            (", ".join(run_index_fields), ", ".join(["?"] * len(values))),
+            values)
+    catalog_changed(db)
+
+def catalog_remove_run(req, run_id):
+    db = open_catalog(req)
+    db.execute("DELETE FROM runs WHERE run_id=?", (run_id,))
+    db.execute("DELETE FROM run_cache WHERE run_id=?", (run_id,))
+    db.execute("DELETE FROM run_members WHERE run_id=?", (run_id,))
+    catalog_changed(db)
+
+# add an index of the files in a run package to the catalog
+# For each member of the package, this has the offset and size of its
+# data, so a file can be read directly from the package.  Only
+# uncompressed packages can be indexed (for others, get_run_file
+# extracts the package).
+def catalog_put_run_members(req, run_id, frp_path, db=None):
+    import tarfile
+    if not db:
+        db = open_catalog(req)
+
+    try:
+        tar = tarfile.open(frp_path, "r:")
+    except (tarfile.TarError, IOError):
+        # compressed or invalid package
+        return
+
+    members = []
+    try:
+        try:
+            for info in tar:
+                # paths are relative to the 'run' directory
+                name = tar_member_name(info.name).rstrip("/")
+                if not name.startswith("run/") or ".." in name.split("/"):
+                    continue
+                if info.isfile() and not info.issparse():
+                    member_type = "f"
+                elif info.isdir():
+                    member_type = "d"
+                else:
+                    member_type = "o"
+                members.append((run_id, name[4:], member_type,
+                    info.offset_data, info.size))
+        except (tarfile.TarError, IOError, EOFError):
+            log_this("Error: could not index run package %s" % frp_path)
+            return
+    finally:
+        tar.close()
+
+    db.execute("DELETE FROM run_members WHERE run_id=?", (run_id,))
+    db.executemany("INSERT OR REPLACE INTO run_members VALUES (?, ?, ?, ?, ?)",
+        members)
+
+# convert a query pattern (see item_match) to an sql condition
+# returns a tuple of (condition, argument), or (None, None) if
+# the pattern matches everything
+def pattern_condition(column, pattern):
+    if pattern == "*":
+        return None, None
+
+    if not pattern.startswith("*") and not pattern.endswith("*"):
+        return "%s = ?" % column, pattern
+
+    # use GLOB, with glob characters in the pattern body escaped
+    glob = pattern
+    prefix = ""
+    suffix = ""
+    if glob.startswith("*"):
+        glob = glob[1:]
+        prefix = "*"
+    if glob.endswith("*"):
+        glob = glob[:-1]
+        suffix = "*"
+    glob = re.sub(r"([*?\[])", r"[\1]", glob)
+    return "%s GLOB ?" % column, prefix + glob + suffix
+
+# return an sql WHERE clause (and its arguments), for rows where all
+# columns match the specified patterns
+# patterns is a dictionary of column names and patterns
+def where_clause(patterns):
+    conditions = []
+    args = []
+    for column, pattern in patterns.items():
+        condition, arg = pattern_condition(column, pattern)
+        if condition:
+            conditions.append(condition)
+            args.append(arg)
+
+    if not conditions:
+        return "", args
+    return " WHERE " + " AND ".join(conditions), args
+
+# return catalog rows where all columns match the specified patterns
+# rows are returned in key order (starting after the key 'after', if
+# specified), and are read from the database as they are used
+def catalog_query(req, table, key, patterns, after=""):
+    db = open_catalog(req)
+
+    where, args = where_clause(patterns)
+    if after:
+        if where:
+            where += " AND %s > ?" % key
+        else:
+            where = " WHERE %s > ?" % key
+        args.append(after)
+    sql = "SELECT * FROM %s%s ORDER BY %s" % (table, where, key)
+
+    # double-check the matches, as a GLOB is not exactly an item_match
+    for row in db.execute(sql, args):
+        for column, pattern in patterns.items():
+            if not item_match(pattern, row[column] or ""):
+                break
+        else:
+            yield row
+
+# get the 'limit' and 'cursor' parameters for a query
+# A query returns at most 'limit' results (0 means no limit), starting
+# after the result named by 'cursor'
+def get_query_limits(req):
+    limit = req.config.query_default_limit
+    try:
+        limit = int(req.form["limit"].value)
+    except:
+        pass
+
+    if limit < 0:
+        send_response("FAIL", "Error: invalid limit %d (must be 0 or more)" % limit)
+
+    # a limit of 0 (no limit) is also capped
+    max_limit = req.config.query_max_limit
+    if max_limit and (not limit or limit > max_limit):
+        limit = max_limit
+
+    try:
+        cursor = req.form["cursor"].value
+    except:
+        cursor = ""
+
+    return limit, cursor
+
+# return True if the results of a query can be sent in parts
+# (older clients don't handle cursors, and send neither parameter)
+def query_is_paged(req):
+    return req.config.query_default_limit or req.form.has_key("limit") \
+        or req.form.has_key("cursor")
+
+# send the results of a query (a list of object names)
+# If there are more than 'limit' results, only the first 'limit'
+# results are sent, followed by a line with the cursor to use
+# to get the next results: "next_cursor=<cursor>"
+# (or, if the query is not paged, an error is sent)
+def send_query_results(req, match_list, limit):
+    if limit and len(match_list) > limit:
+        if not query_is_paged(req):
+            msg = "Error: more than %d results " % limit + \
+                "(use 'limit' and 'cursor' to get them in parts)"
+            send_response("FAIL", msg)
+        match_list = match_list[:limit]
+        if match_list:
+            match_list.append("next_cursor=" + match_list[-1])
+
+    send_response("OK", "".join([item + "\n" for item in match_list]))
+
+#######################
+# run cache
+#
+# Run packages are not extracted when they are uploaded (except for
+# their run.json file).  A run is extracted into files/runs/<run_dir>
+# when a file in it is requested (see do_get_run_file), and the
+# run_cache table in the catalog records the size and last access time
+# of each extracted directory.  When the total size is over
+# config.run_cache_max_bytes, the least recently used directories are
+# removed.
+
+def dir_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            size += os.lstat(dirpath + os.sep + f).st_size
+    return size
+
+# prefix of temporary directories, used while extracting or removing
+# run directories (these are not run directories)
+run_temp_prefix = ".tmp-"
+
+def is_run_temp_dir(name):
+    # older versions used the tempfile default prefix
+    return name.startswith(run_temp_prefix) or name.startswith("tmp")
+
+# return the path of the extracted directory for a run, extracting the
+# run package if needed.
+# returns (error, run_dir_path)
+def get_run_dir(req, run_id):
+    run_file_dir = req.config.files_dir + os.sep + "runs"
+    run_dir_path = run_file_dir + os.sep + run_id[4:]
+    db = open_catalog(req)
+
+    if os.path.isdir(run_dir_path):
+        cursor = db.execute("UPDATE run_cache SET last_access=? WHERE run_id=?",
+            (time.time(), run_id))
+        if cursor.rowcount:
+            return "", run_dir_path
+    else:
+        frp_path = run_file_dir + os.sep + run_id + ".frp"
+        if not os.path.exists(frp_path):
+            return "Error: filepath %s does not exist\n" % frp_path, ""
+
+        # extract into a temporary directory, then move the 'run'
+        # directory into place
+        import shutil
+        tempdir = tempfile.mkdtemp(dir=run_file_dir, prefix=run_temp_prefix)
+        try:
+            error = extract_tar(frp_path, tempdir)
+            if not error and not os.path.isdir(tempdir + "/run"):
+                error = "Error: missing 'run' directory in run package\n"
+            if not error:
+                try:
+                    os.rename(tempdir + "/run", run_dir_path)
+                except OSError:
+                    # another request extracted it first
+                    if not os.path.isdir(run_dir_path):
+                        raise
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+        if error:
+            return error, ""
+
+    db.execute("INSERT OR REPLACE INTO run_cache VALUES (?, ?, ?)",
+        (run_id, dir_size(run_dir_path), time.time()))
+    evict_run_dirs(req, db, run_id)
+    return "", run_dir_path
+
+# remove the least recently used run directories, until the cache is
+# under its maximum size (but keep the directory for keep_run_id)
+def evict_run_dirs(req, db, keep_run_id):
+    total = db.execute("SELECT SUM(size) FROM run_cache").fetchone()[0] or 0
+    if total <= req.config.run_cache_max_bytes:
+        return
+
+    rows = db.execute("SELECT run_id, size FROM run_cache WHERE run_id != ? ORDER BY last_access",
+        (keep_run_id,)).fetchall()
+    for row in rows:
+        if total <= req.config.run_cache_max_bytes:
+            break
+        remove_run_dir(req, row["run_id"])
+        db.execute("DELETE FROM run_cache WHERE run_id=?", (row["run_id"],))
+        total -= row["size"]
+
+# remove the extracted directory for a run, if present
+def remove_run_dir(req, run_id):
+    import shutil
+    run_file_dir = req.config.files_dir + os.sep + "runs"
+    run_dir_path = run_file_dir + os.sep + run_id[4:]
+
+    # runs uploaded before lazy extraction have their run.json data file
+    # symlinked into the run directory.  Replace it with a copy.
+    json_path = req.config.data_dir + os.sep + "runs" + os.sep + run_id + ".json"
+    if os.path.islink(json_path) and \
+            os.path.realpath(json_path).startswith(run_dir_path + os.sep):
+        fd, temppath = tempfile.mkstemp(dir=os.path.dirname(json_path))
+        os.close(fd)
+        try:
+            shutil.copyfile(json_path, temppath)
+            os.chmod(temppath, 0644)
+            os.rename(temppath, json_path)
+        except:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+
+    if not os.path.isdir(run_dir_path):
+        return
+
+    # move the directory out of the way first, so it is never seen
+    # partially removed
+    tempdir = tempfile.mkdtemp(dir=run_file_dir, prefix=run_temp_prefix)
+    os.rename(run_dir_path, tempdir + "/run")
+    shutil.rmtree(tempdir)
+
 def do_put_test(req):
     upload_dir = req.config.files_dir + os.sep + "tests"
-    result, msg, filepath = save_file(req, "file1", upload_dir)
+    result, msg, filepath = save_file(req, "file1", upload_dir, use_blobs=True)
 
     if result != "OK":
         send_response(result, msg)
@@ -265,7 +1483,8 @@ def do_put_test(req):
         os.unlink(filepath)
         send_response("FAIL", msg)
 
-    msg += "Created %s\n" % filepath
+    if not req.upload_duplicate:
+        msg += "Created %s\n" % filepath
 
     test_name = filename.split("-",1)[0]
 
@@ -275,18 +1494,21 @@ def do_put_test(req):
     tdd = test_data_dir
     tn = test_name
     tn_with_version = filename[:-4]
-    cmd = "tar -C %s -xf %s %s/test.yaml" % (tdd, filepath, tn)
-    result = os.system(cmd)
-    yaml_src_name = "%s/%s/test.yaml" % (tdd, tn)
     yaml_dest_name = "%s/%s.yaml" % (tdd, tn_with_version)
-    if not os.path.exists(yaml_src_name):
-        msg += "Error: can't find %s\n in extracted .ftp contents" % yaml_src_name
-        send_response("FAIL", msg)
 
-    os.rename(yaml_src_name, yaml_dest_name)
-    os.rmdir("%s/%s" % (tdd, tn))
+    # a re-upload is done, unless the earlier put did not finish
+    if req.upload_duplicate and upload_complete(yaml_dest_name):
+        send_response("OK", msg)
+
+    error = extract_tar_member(filepath, "%s/test.yaml" % tn, yaml_dest_name)
+    if error:
+        msg += error
+        os.unlink(filepath)
+        send_response("FAIL", msg)
 
     msg += "Extracted %s from uploaded file\n" % yaml_dest_name
+    write_digest_file(req, yaml_dest_name[:-5], filepath)
+    journal_object(req, "put", "test", tn_with_version)
 
     # create wrapper tbwiki page for test
 #    page_content = """Here is data for test package %(page_name)s:
@@ -306,7 +1528,7 @@ def do_put_test(req):
 
 def do_put_binary_package(req):
     upload_dir = req.config.files_dir + os.sep + "binary-packages"
-    result, msg, filepath = save_file(req, "file1", upload_dir)
+    result, msg, filepath = save_file(req, "file1", upload_dir, use_blobs=True)
 
     if result != "OK":
         send_response(result, msg)
@@ -318,7 +1540,8 @@ def do_put_binary_package(req):
         os.unlink(filepath)
         send_response("FAIL", msg)
 
-    msg += "Created %s\n" % filepath
+    if not req.upload_duplicate:
+        msg += "Created %s\n" % filepath
 
     # figure out filename parts
     if "-Functional." in filename:
@@ -342,17 +1565,21 @@ def do_put_binary_package(req):
     bpdd = bp_data_dir
     tc = toolchain
     tn = test_name
-    cmd = "tar -C %s -xf %s ./binary-package.json" % (bpdd, filepath)
-    result = os.system(cmd)
-    json_src_name = "%s/binary-package.json" % (bpdd)
     json_dest_name = "%s/%s-%s.json" % (bpdd, tc, tn)
-    if not os.path.exists(json_src_name):
-        msg += "Error: can't find %s\n in extracted .ftbp contents" % json_src_name
-        send_response("FAIL", msg)
 
-    os.rename(json_src_name, json_dest_name)
+    # a re-upload is done, unless the earlier put did not finish
+    if req.upload_duplicate and upload_complete(json_dest_name):
+        send_response("OK", msg)
+
+    error = extract_tar_member(filepath, "binary-package.json", json_dest_name)
+    if error:
+        msg += error
+        os.unlink(filepath)
+        send_response("FAIL", msg)
 
     msg += "Extracted %s from uploaded file\n" % json_dest_name
+    write_digest_file(req, json_dest_name[:-5], filepath)
+    journal_object(req, "put", "binary_package", "%s-%s" % (tc, tn))
 
     # create wrapper tbwiki page for binary package
 #    page_content = """Here is data for test binary package %(page_name)s:
@@ -374,17 +1601,9 @@ def do_put_binary_package(req):
 def do_put_run(req):
     upload_dir = req.config.files_dir + os.sep + "runs"
 
-    try:
-        req.form = cgi.FieldStorage(strict_parsing=1)
-
-    except:
-        log_this("Exception calling cgi.FieldStorage()")
-        import traceback
-        emsg = traceback.format_exc()
-        log_this(emsg)
-        send_response("FAIL", "Exception calling cgi.FieldStorage()")
-
     result, msg, filepath = save_file(req, "file1", upload_dir)
+    if result != "OK":
+        send_response(result, msg)
 
     # FIXTHIS - should check the filepath syntax here (don't allow .., etc.)
 
@@ -398,35 +1617,24 @@ def do_put_run(req):
     run_id = filename[4:-4]
     msg += "Created %s\n" % filepath
 
-    # extra data under files/runs
-    run_file_dir = req.config.files_dir + os.sep + "runs"
-    tempdir = tempfile.mkdtemp(dir=run_file_dir)
-
-    # extract .frp into files/runs/<tempdir>
-    # it will leave a 'run' directory in that dir
-    cmd = "tar -C %s -xf %s --force-local" % (tempdir, filepath)
-    msg += "Tar cmd=%s\n" % cmd
-    rcode = os.system(cmd)
-    if rcode != 0:
-        send_response("FAIL", msg+"Could not extract file from run package\n")
-
     # FIXTHIS - should add a manifest to .frp files, and sanity check here
 
-    # move files/runs/<tempdir>/run directory to files/runs/<rundir>
-    tmp_run_name = tempdir + "/run"
-    rundir_name = run_file_dir + os.sep + run_id
-    os.rename(tmp_run_name, rundir_name)
-
-    # symlink run.json file to data/runs/run-<run_id>.son
-    json_src_name = rundir_name + os.sep + "run.json"
-    if not os.path.exists(json_src_name):
-        msg += "Error: can't find %s\n in extracted .frp contents\n" % json_src_name
-        send_response("FAIL", msg)
-
+    # extract just the run.json file to data/runs/run-<run_id>.json
+    # the rest of the package is extracted when it is used (see get_run_dir)
     run_data_dir = req.config.data_dir + os.sep + "runs"
     json_dest_name = "%s/run-%s.json" % (run_data_dir, run_id)
-    os.symlink(json_src_name, json_dest_name)
-    os.rmdir(tempdir)
+    error = extract_tar_member(filepath, "run/run.json", json_dest_name)
+    if error:
+        send_response("FAIL", msg+error+"Could not extract file from run package\n")
+    write_digest_file(req, json_dest_name[:-5], filepath)
+    catalog_put_run_members(req, "run-" + run_id, filepath)
+
+    try:
+        run_dict = read_json_file(json_dest_name)
+    except:
+        run_dict = None
+    catalog_put_run(req, "run-" + run_id, run_dict)
+    journal_object(req, "put", "run", "run-" + run_id)
 
     # FIXTHIS - return url here instead of full server path??
     msg += "Extracted %s from uploaded file\n" % json_dest_name
@@ -436,6 +1644,300 @@ def do_put_run(req):
 
     send_response("OK", msg)
 
+#######################
+# object locking
+#
+# Updates to an object's json file (read, modify, write) are done while
+# holding a lock for that object, so concurrent updates (e.g. from two
+# labs, or a lab and timeout_requests) don't overwrite each other.  Each
+# object has its own lock file, in data/locks, so updates to different
+# objects don't wait for each other.
+#
+# Each update also increments the 'revision' field of the object.  A
+# client can make an update conditional, with the expected_version
+# (the revision it last read) and expected_state fields.
+
+class object_lock:
+    def __init__(self, req, filepath, blocking=True):
+        self.path = req.config.data_dir + os.sep + "locks" + os.sep + \
+            os.path.basename(filepath) + ".lock"
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        # raises IOError if not blocking, and the lock is held elsewhere
+        import fcntl
+        lock_dir = os.path.dirname(self.path)
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:
+                # made by another process
+                pass
+        self.fd = open(self.path, "a")
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd.fileno(), flags)
+        except IOError:
+            self.fd.close()
+            raise
+        return self
+
+    def __exit__(self, etype, evalue, etb):
+        # closing the file releases the lock
+        self.fd.close()
+        self.fd = None
+        return False
+
+# fields of an update that are conditions, instead of new data
+condition_fields = ["expected_version", "expected_state"]
+
+# check the conditions of an update (from the form) against the current
+# data of an object.  Returns an error message, or "" if the update can
+# proceed.
+def check_update_conditions(req, obj_dict):
+    msg = ""
+    revision = obj_dict.get("revision", 0)
+    state = obj_dict.get("state", "")
+    if req.form.has_key("expected_version") and \
+            req.form["expected_version"].value != str(revision):
+        msg += "Error: conflict - expected version %s, but the current version is %s\n" % \
+            (req.form["expected_version"].value, revision)
+    if req.form.has_key("expected_state") and \
+            req.form["expected_state"].value != state:
+        msg += "Error: conflict - expected state '%s', but the current state is '%s'\n" % \
+            (req.form["expected_state"].value, state)
+    return msg
+
+def next_revision(obj_dict):
+    try:
+        return int(obj_dict.get("revision", 0)) + 1
+    except ValueError:
+        return 1
+
+#######################
+# request journal
+#
+# Changes to requests (create, update, claim, timeout and remove) are
+# appended to a journal, with one file per day:
+#   data/journal/journal-YYYY-MM-DD.jsonl
+# Each line is a json object with the time, event, object type
+# ("request") and request_id, and (except for remove) the request
+# fields that were set, including the new revision.  So changing a
+# request is a single small append, instead of rewriting its file.
+#
+# Puts and removes of other objects (runs, tests, binary packages and
+# boards) are also recorded in the journal, with the object type and
+# id, so that clients can watch for all changes (see do_watch).
+#
+# The current request data is kept in the catalog.  The request files
+# in data/requests are snapshots, which compact_journal() brings up to
+# date, by applying the journal entries since the last checkpoint.  The
+# checkpoint (the journal position that the snapshots include) is kept
+# in data/journal/checkpoint.  Journal files are not removed, and are
+# the history of each request (see get_request_history).
+
+def get_journal_dir(req):
+    return req.config.data_dir + os.sep + "journal"
+
+# notified when a change is added to the journal
+journal_condition = threading.Condition()
+
+def journal_request(req, event, request_id, fields=None):
+    entry = {"event": event, "object": "request", "request_id": request_id}
+    if fields is not None:
+        entry["data"] = fields
+    journal_change(req, entry)
+
+# record a change to another object type ("run", "test",
+# "binary_package" or "board")
+def journal_object(req, event, object_type, object_id):
+    journal_change(req, {"event": event, "object": object_type,
+        "id": object_id})
+
+def journal_change(req, entry):
+    import json
+    entry["time"] = get_timestamp()
+
+    journal_dir = get_journal_dir(req)
+    if not os.path.isdir(journal_dir):
+        try:
+            os.makedirs(journal_dir)
+        except OSError:
+            # made by another process
+            pass
+    filename = "journal-%s.jsonl" % time.strftime("%Y-%m-%d", time.gmtime())
+    append_file(req, journal_dir + os.sep + filename,
+        json.dumps(entry, sort_keys=True) + "\n")
+
+    with journal_condition:
+        journal_condition.notify_all()
+
+def get_journal_files(req):
+    try:
+        filelist = [f for f in os.listdir(get_journal_dir(req))
+            if f.startswith("journal-") and f.endswith(".jsonl")]
+    except OSError:
+        return []
+    filelist.sort()
+    return filelist
+
+# return the position after the last complete entry in the journal,
+# or None if the journal is empty
+def get_journal_end(req):
+    filelist = get_journal_files(req)
+    if not filelist:
+        return None
+
+    f = filelist[-1]
+    fd = open(get_journal_dir(req) + os.sep + f)
+    fd.seek(0, 2)
+    size = fd.tell()
+    # look for the end of the last line (lines are much shorter than this)
+    start = max(0, size - 65536)
+    fd.seek(start)
+    data = fd.read()
+    fd.close()
+    return (f, start + data.rfind("\n") + 1)
+
+# read journal entries, starting at position 'start' (a (filename,
+# offset) tuple, or None for the start of the journal)
+# Yields (entry, position after the entry).
+# A line that is still being written is not read.
+def read_journal(req, start=None):
+    import json
+    journal_dir = get_journal_dir(req)
+    filelist = get_journal_files(req)
+    for f in filelist:
+        offset = 0
+        if start:
+            if f < start[0]:
+                continue
+            if f == start[0]:
+                offset = start[1]
+
+        filepath = journal_dir + os.sep + f
+        fd = open(filepath)
+        fd.seek(offset)
+        while True:
+            line = fd.readline()
+            if not line:
+                break
+            if not line.endswith("\n"):
+                # a partial line, at the end of a file, is still being
+                # written, unless it was cut off (by a crash) long ago
+                if f == filelist[-1] or \
+                        time.time() - os.path.getmtime(filepath) < 60:
+                    fd.close()
+                    return
+                log_this("Error: partial entry at end of journal file %s" % f)
+                break
+            offset += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log_this("Error: bad entry in journal file %s, at offset %d" % (f, offset - len(line)))
+                continue
+            yield entry, (f, offset)
+        fd.close()
+
+# apply a journal entry to request data (None if there is no request)
+# Returns the new request data, or None if the request was removed.
+# The journal may be applied to snapshots that already include some
+# of its entries, so entries are only applied to older revisions.
+def apply_journal_entry(req_dict, entry):
+    fields = entry.get("data", {})
+    if entry["event"] == "remove":
+        return None
+    if entry["event"] == "create":
+        if req_dict is None:
+            return dict(fields)
+        return req_dict
+    if req_dict is None:
+        # the request was removed
+        return None
+    if fields.get("revision", 0) > req_dict.get("revision", 0):
+        req_dict = dict(req_dict)
+        req_dict.update(fields)
+    return req_dict
+
+def read_checkpoint(req):
+    try:
+        checkpoint = read_json_file(get_journal_dir(req) + os.sep + "checkpoint")
+        return (checkpoint["file"], checkpoint["offset"])
+    except (IOError, ValueError, KeyError):
+        return None
+
+# bring the request files up to date with the journal, and move the
+# checkpoint to the end of the journal.
+# Returns the number of request files written (or removed).
+def compact_journal(req):
+    req_data_dir = req.config.data_dir + os.sep + "requests"
+    checkpoint_path = get_journal_dir(req) + os.sep + "checkpoint"
+    if not os.path.isdir(get_journal_dir(req)):
+        return 0
+
+    # only one compaction is done at a time
+    with object_lock(req, checkpoint_path):
+        start = read_checkpoint(req)
+        end = start
+        request_entries = {}
+        for entry, position in read_journal(req, start):
+            if "request_id" in entry:
+                request_entries.setdefault(entry["request_id"], []).append(entry)
+            end = position
+        if end == start:
+            return 0
+
+        for request_id, entries in request_entries.items():
+            filepath = req_data_dir + os.sep + request_id + ".json"
+            with object_lock(req, filepath):
+                try:
+                    req_dict = read_json_file(filepath)
+                except IOError:
+                    req_dict = None
+                for entry in entries:
+                    req_dict = apply_journal_entry(req_dict, entry)
+
+                if req_dict is not None:
+                    write_json_file(req, filepath, req_dict)
+                elif os.path.exists(filepath):
+                    os.remove(filepath)
+
+        write_json_file(req, checkpoint_path,
+            {"file": end[0], "offset": end[1]})
+
+    return len(request_entries)
+
+# return the journal entries for a request, as a json list
+def do_get_request_history(req):
+    msg = ""
+
+    try:
+        request_id = req.form["request_id"].value
+    except:
+        msg += "Error: can't read request_id from form"
+        send_response("FAIL", msg)
+
+    id_parts = parse_request_id(request_id)
+    if not id_parts:
+        msg += "Error: invalid request_id '%s'" % request_id
+        send_response("FAIL", msg)
+
+    # the request can't be in journal files from before it was made
+    start = ("journal-%s.jsonl" % id_parts[0][:10], 0)
+    history = [entry for entry, position in read_journal(req, start)
+        if entry.get("request_id") == request_id]
+    if not history:
+        msg += "Error: no history found for request %s" % request_id
+        send_response("FAIL", msg)
+
+    import json
+    data = json.dumps(history, sort_keys=True, indent=4, separators=(',', ': '))
+    send_response("OK", data)
+
 def do_put_board(req):
     req_data_dir = req.config.data_dir + os.sep + "boards"
     result = "OK"
@@ -464,11 +1966,15 @@ def do_put_board(req):
         jfilepath = req_data_dir + os.sep + filename + ".json"
 
         # convert to json and save to file
-        import json
-        data = json.dumps(mydict, sort_keys=True, indent=4, separators=(',', ': '))
-        fout = open(jfilepath, "w")
-        fout.write(data+'\n')
-        fout.close()
+        with object_lock(req, jfilepath):
+            # a board may be put again, replacing its data
+            old_dict = {}
+            if os.path.exists(jfilepath):
+                old_dict = read_json_file(jfilepath)
+            mydict["revision"] = next_revision(old_dict)
+            write_json_file(req, jfilepath, mydict)
+        catalog_refresh_deadlines(req, host, board)
+        journal_object(req, "put", "board", "%s:%s" % (host, board))
 
     send_response(result, msg)
 
@@ -480,7 +1986,8 @@ def do_update_board(req):
     #convert form (cgi.fieldStorage) to dictionary
     new_dict = {}
     for k in req.form.keys():
-        new_dict[k] = req.form[k].value
+        if k not in condition_fields:
+            new_dict[k] = req.form[k].value
 
     # remove action
     del(new_dict["action"])
@@ -508,23 +2015,29 @@ def do_update_board(req):
     # FIXTHIS - should validate that user has authorization to modify the board
 
     import json
-    board_fd = open(jfilepath, "r")
-    board_dict = json.load(board_fd)
-    board_fd.close()
+    with object_lock(req, jfilepath):
+        board_fd = open(jfilepath, "r")
+        board_dict = json.load(board_fd)
+        board_fd.close()
 
-    # FIXTHIS - prevent client from updating certain fields
+        error = check_update_conditions(req, board_dict)
+        if error:
+            send_response("FAIL", msg+error)
 
-    # don't need to filter these, as they should match
-    #del(new_dict["host"])
-    #del(new_dict["board"])
-    board_dict.update(new_dict)
+        # FIXTHIS - prevent client from updating certain fields
 
-    # convert to json and save to file
-    data = json.dumps(board_dict, sort_keys=True, indent=4, separators=(',', ': '))
-    fout = open(jfilepath, "w")
-    fout.write(data+'\n')
-    fout.close()
+        # don't need to filter these, as they should match
+        #del(new_dict["host"])
+        #del(new_dict["board"])
+        board_dict.update(new_dict)
+        board_dict["revision"] = next_revision(board_dict)
+
+        # convert to json and save to file
+        write_json_file(req, jfilepath, board_dict)
+    catalog_refresh_deadlines(req, host, board)
+    journal_object(req, "update", "board", "%s:%s" % (host, board))
 
+    msg += "revision=%d\n" % board_dict["revision"]
     send_response(result, msg)
 
 def do_get_board(req):
@@ -549,16 +2062,19 @@ def do_get_board(req):
         send_response("FAIL", msg)
         return
 
+    # don't send the data again, if the client has it
+    headers = check_not_modified(req, file_etag(jfilepath),
+        os.path.getmtime(jfilepath))
+
     # send json file to client
     board_fd = open(jfilepath, "r")
     data = board_fd.read()
     board_fd.close()
 
-    send_response(result, data)
+    send_response(result, data, headers)
 
 
 def do_put_request(req):
-    req_data_dir = req.config.data_dir + os.sep + "requests"
     result = "OK"
     msg = ""
 
@@ -568,8 +2084,7 @@ def do_put_request(req):
         mydict[k] = req.form[k].value
 
     mydict["state"] = "pending"
-    timestamp = get_timestamp()
-    mydict["request_time"] = timestamp
+    mydict["revision"] = 1
 
     # remove action
     del(mydict["action"])
@@ -595,17 +2110,18 @@ def do_put_request(req):
         send_response(result, msg)
         return
 
+    timestamp = allocate_request_timestamp(req)
+    mydict["request_time"] = timestamp
+
     filename = "request-%s-%s:%s" % (timestamp, host, board)
-    jfilepath = req_data_dir + os.sep + filename + ".json"
 
     msg += "request_id=%s\n" % filename
 
-    # convert to json and save to file here
-    import json
-    data = json.dumps(mydict, sort_keys=True, indent=4, separators=(',', ': '))
-    fout = open(jfilepath, "w")
-    fout.write(data+'\n')
-    fout.close()
+    # record the request in the journal (the request file is written
+    # when the journal is compacted)
+    journal_request(req, "create", filename, mydict)
+    catalog_put_request(req, filename, mydict)
+    notify_new_request()
 
     send_response(result, msg)
 
@@ -621,34 +2137,39 @@ def do_update_request(req):
 
     filename = request_id + ".json"
     filepath = req_data_dir + os.sep + filename
-    if not os.path.exists(filepath):
-        msg += "Error: filepath %s does not exist" % filepath
-        send_response("FAIL", msg)
 
-    # read requested file
     import json
-    request_fd = open(filepath, "r")
-    req_dict = json.load(request_fd)
-    request_fd.close()
-
-    # update fields from (cgi.fieldStorage)
-    for k in req.form.keys():
-        if k in ["request_id", "action"]:
-            # skip these
-            continue
-        if k in ["state", "run_id", "start_time", "done_time", "reason"]:
-            # FIXTHIS - could check the data input here
-            req_dict[k] = req.form[k].value
-        else:
-            msg = "Error - can't change field '%s' in request" % k
+    with object_lock(req, filepath):
+        req_dict = catalog_get_request(req, request_id)
+        if req_dict is None:
+            msg += "Error: request %s does not exist" % request_id
             send_response("FAIL", msg)
 
-    # put dictionary back in json format (beautified)
-    data = json.dumps(req_dict, sort_keys=True, indent=4, separators=(',', ': '))
-    fout = open(filepath, "w")
-    fout.write(data+'\n')
-    fout.close()
+        error = check_update_conditions(req, req_dict)
+        if error:
+            send_response("FAIL", msg+error)
+
+        # get updated fields from (cgi.fieldStorage)
+        fields = {}
+        for k in req.form.keys():
+            if k in ["request_id", "action"] or k in condition_fields:
+                # skip these
+                continue
+            if k in ["state", "run_id", "start_time", "done_time", "reason"]:
+                # FIXTHIS - could check the data input here
+                fields[k] = req.form[k].value
+            else:
+                msg = "Error - can't change field '%s' in request" % k
+                send_response("FAIL", msg)
+        fields["revision"] = next_revision(req_dict)
+        req_dict.update(fields)
+
+        journal_request(req, "update", request_id, fields)
+        catalog_put_request(req, request_id, req_dict)
+    if req_dict.get("state") == "pending":
+        notify_new_request()
 
+    data = json.dumps(req_dict, sort_keys=True, indent=4, separators=(',', ': '))
     send_response("OK", data)
 
 # try matching with simple wildcards (* at start or end of string)
@@ -671,10 +2192,10 @@ def item_match(pattern, item):
 def do_query_boards(req):
     #log_this("in do_query_boards")
     board_data_dir = req.config.data_dir + os.sep + "boards"
-    msg = ""
 
+    # sort by board name (the order of the cursor)
     filelist = os.listdir(board_data_dir)
-    filelist.sort()
+    filelist.sort(key=lambda f: f[6:-5])
 
     # can query by different fields, some in the name and some inside
     # the json
@@ -689,26 +2210,27 @@ def do_query_boards(req):
     except:
         query_board = "*"
 
+    limit, cursor = get_query_limits(req)
+
     # handle host and board-based queries
     match_list = []
     for f in filelist:
         if f.startswith("board-") and f.endswith("json"):
             host_and_board = f[6:-5]
-            if not host_and_board:
+            if not host_and_board or host_and_board <= cursor:
                 continue
             if not item_match(query_host, host_and_board.split(":")[0]):
                 continue
             if not item_match(query_board, host_and_board.split(":")[1]):
                 continue
             match_list.append(host_and_board)
+            if limit and len(match_list) > limit:
+                break
 
     # FIXTHIS - read files and filter by attributes
     # particularly filter on 'state'
 
-    for host_and_board in match_list:
-       msg += host_and_board+"\n"
-
-    send_response("OK", msg)
+    send_query_results(req, match_list, limit)
 
 
 def do_query_requests(req):
@@ -716,14 +2238,9 @@ def do_query_requests(req):
     timeout_requests(req)
 
     #log_this("in do_query_requests")
-    req_data_dir = req.config.data_dir + os.sep + "requests"
-    msg = ""
 
-    filelist = os.listdir(req_data_dir)
-    filelist.sort()
-
-    # can query by different fields, some in the name and some inside
-    # the json
+    # can query by different fields, some of which are indexed in
+    # the catalog, and some of which are only inside the json
 
     try:
         query_host = req.form["host"].value
@@ -735,74 +2252,48 @@ def do_query_requests(req):
     except:
         query_board = "*"
 
-    # handle host and board-based queries
-    match_list = []
-    for f in filelist:
-        if f.startswith("request-") and f.endswith("json"):
-            host_and_board = f[31:-5]
-            if not host_and_board:
-                continue
-            if not item_match(query_host, host_and_board.split(":")[0]):
-                continue
-            if not item_match(query_board, host_and_board.split(":")[1]):
-                continue
-            match_list.append(f)
-
-    # read files and filter by attributes
-    # (particularly filter on 'state')
-    if match_list:
-        import json
-
-        # read the first file to get the list of possible attributes
-        f = match_list[0]
-        with open(req_data_dir + os.sep + f) as jfd:
-            data = json.load(jfd)
-            # get a list of valid attributes
-            fields = data.keys()
-
-            # get rid of fields already processed
-            fields.remove("host")
-            fields.remove("board")
-
-        # check the form for query attributes
-        # if they have the same name as a valid field, then add to list
-        query_fields={}
-        for field in fields:
-            try:
-                query_fields[field] = req.form[field].value
-            except:
-                pass
+    # handle queries on indexed fields, using the catalog
+    index_patterns = {"host": query_host, "board": query_board}
+    for field in request_index_fields:
+        if field not in index_patterns and req.form.has_key(field):
+            index_patterns[field] = req.form[field].value
 
-        # if more to query by, then go through files, preserving matches
-        if query_fields:
-            ml_tmp = []
-            for f in match_list:
-                drop = False
-                with open(req_data_dir + os.sep + f) as jfd:
-                    data = json.load(jfd)
-                    for field, pattern in query_fields.items():
-                        if not item_match(pattern, str(data[field])):
-                            drop = True
-                if not drop:
-                    ml_tmp.append(f)
-            match_list = ml_tmp
-
-    for f in match_list:
-        # remove .json extension from request filename, to get the req_id
-        req_id = f[:-5]
-        msg += req_id+"\n"
+    limit, cursor = get_query_limits(req)
+
+    # filter by other attributes, using the request data in the catalog
+    import json
+    query_fields = None
+    match_list = []
+    for row in catalog_query(req, "requests", "request_id", index_patterns,
+            cursor):
+        data = json.loads(row["data"])
+        if query_fields is None:
+            # use the first match to get the list of possible attributes
+            # check the form for query attributes
+            # if they have the same name as a valid field, then add to list
+            query_fields = {}
+            for field in data.keys():
+                if field in index_patterns:
+                    continue
+                try:
+                    query_fields[field] = req.form[field].value
+                except:
+                    pass
+
+        for field, pattern in query_fields.items():
+            if not item_match(pattern, str(data.get(field, ""))):
+                break
+        else:
+            match_list.append(row["request_id"])
+            if limit and len(match_list) > limit:
+                break
 
-    send_response("OK", msg)
+    send_query_results(req, match_list, limit)
 
 def do_query_runs(req):
-    run_data_dir = req.config.data_dir + os.sep + "runs"
-    msg = ""
-
-    filelist = os.listdir(run_data_dir)
-    filelist.sort()
 
-    # can query by different fields, some in the name and some inside
-    # the json
+    # can query by different fields, some of which are indexed in
+    # the catalog, and some of which are only inside the json
 
     try:
         query_host = req.form["host"].value
@@ -814,77 +2305,50 @@ def do_query_runs(req):
     except:
         query_board = "*"
 
-    # handle host and board-based queries
-    match_list = []
-    for f in filelist:
-        if f.startswith("run-") and f.endswith("json"):
-            # last item after "-on-", with '.json' removed
-            host_and_board = f.split("-on-")[-1][:-5]
-            if not host_and_board:
-                continue
-            if ":" not in host_and_board:
-                # not sure what happened here - bad filename?
-                log_this("Error: Invalid host:board: '%s' in filename %s" % (host_and_board, f))
-                continue
-            if not item_match(query_host, host_and_board.split(":")[0]):
-                continue
-            if not item_match(query_board, host_and_board.split(":")[1]):
-                continue
-            match_list.append(f)
-
-    # read files and filter by attributes
-    # (should particularly filter on 'requestor' or 'request_id')
-    if match_list:
-        import json
-
-        # read the first file to get the list of possible attributes
-        f = match_list[0]
-        with open(run_data_dir + os.sep + f) as jfd:
-            data = json.load(jfd)
-            # get a list of valid attributes
-            fields = data["metadata"].keys()
-
-            # get rid of fields already processed
-            fields.remove("host_name")
-            fields.remove("board")
-
-        # check the form for query attributes
-        # if they have the same name as a valid field, then add to list
-        query_fields={}
-        for field in fields:
-            try:
-                query_fields[field] = req.form[field].value
-            except:
-                pass
+    # handle queries on indexed fields, using the catalog
+    index_patterns = {"host_name": query_host, "board": query_board}
+    for field in run_index_fields:
+        if field not in index_patterns and req.form.has_key(field):
+            index_patterns[field] = req.form[field].value
 
-        # if more to query by, then go through files, preserving matches
-        if query_fields:
-            ml_tmp = []
-            for f in match_list:
-                drop = False
-                with open(run_data_dir + os.sep + f) as jfd:
-                    data = json.load(jfd)
-                    for field, pattern in query_fields.items():
-                        if not item_match(pattern, str(data["metadata"][field])):
-                            drop = True
-                if not drop:
-                    ml_tmp.append(f)
-            match_list = ml_tmp
-
-    for f in match_list:
-        # run_id = run filename minus .json extension
-        run_id = f[:-5]
-        msg += run_id+"\n"
+    limit, cursor = get_query_limits(req)
 
-    send_response("OK", msg)
+    # filter by other attributes, using the run metadata in the catalog
+    import json
+    query_fields = None
+    match_list = []
+    for row in catalog_query(req, "runs", "run_id", index_patterns, cursor):
+        metadata = json.loads(row["metadata"])
+        if query_fields is None:
+            # use the first match to get the list of possible attributes
+            # check the form for query attributes
+            # if they have the same name as a valid field, then add to list
+            query_fields = {}
+            for field in metadata.keys():
+                if field in index_patterns:
+                    continue
+                try:
+                    query_fields[field] = req.form[field].value
+                except:
+                    pass
+
+        for field, pattern in query_fields.items():
+            if not item_match(pattern, str(metadata.get(field, ""))):
+                break
+        else:
+            match_list.append(row["run_id"])
+            if limit and len(match_list) > limit:
+                break
+
+    send_query_results(req, match_list, limit)
 
 def do_query_tests(req):
     test_data_dir = req.config.data_dir + os.sep + "tests"
     test_files_dir = req.config.files_dir + os.sep + "tests"
-    msg = ""
 
+    # sort by package name (the order of the cursor)
     filelist = os.listdir(test_data_dir)
-    filelist.sort()
+    filelist.sort(key=lambda f: f[:-5])
 
     # can query by different fields, all in the filename for now
     try:
@@ -902,6 +2366,8 @@ def do_query_tests(req):
         query_release = "*"
 
 
+    limit, cursor = get_query_limits(req)
+
     # handle queries
     match_list = []
     for f in filelist:
@@ -918,20 +2384,21 @@ def do_query_tests(req):
             if not item_match(query_release, release):
                 continue
             package_name = f[:-5]
+            if package_name <= cursor:
+                continue
             match_list.append(package_name)
+            if limit and len(match_list) > limit:
+                break
 
-    for f in match_list:
-       msg += f+"\n"
-
-    send_response("OK", msg)
+    send_query_results(req, match_list, limit)
 
 def do_query_binary_tests(req):
     test_data_dir = req.config.data_dir + os.sep + "binary-packages"
     test_files_dir = req.config.files_dir + os.sep + "binary-packages"
-    msg = ""
 
+    # sort by package name (the order of the cursor)
     filelist = os.listdir(test_data_dir)
-    filelist.sort()
+    filelist.sort(key=lambda f: f[:-5])
 
     # can query by different fields, all in the filename for now
     try:
@@ -952,6 +2419,8 @@ def do_query_binary_tests(req):
         query_release = "*"
 
 
+    limit, cursor = get_query_limits(req)
+
     # handle queries
     match_list = []
     for f in filelist:
@@ -990,12 +2459,13 @@ def do_query_binary_tests(req):
             #if not item_match(query_release, release):
             #    continue
             package_name = f[:-5]
+            if package_name <= cursor:
+                continue
             match_list.append(package_name)
+            if limit and len(match_list) > limit:
+                break
 
-    for f in match_list:
-       msg += f+"\n"
-
-    send_response("OK", msg)
+    send_query_results(req, match_list, limit)
 
 def read_tbwikidb_file(file_path):
     # try opening the file
@@ -1049,9 +2519,207 @@ def read_tbwikidb_file(file_path):
 
     return record
 
-# FIXTHIS - could do get_next_request (with wildcards) to save a query
-def do_get_request(req):
+# notified when a request becomes pending, to wake up get_next_request
+new_request_condition = threading.Condition()
+
+def notify_new_request():
+    with new_request_condition:
+        new_request_condition.notify_all()
+
+# claim the oldest pending request for a host and board (which may be
+# patterns), by setting its state to 'running'
+# returns (request_id, req_dict), or (None, None) if none are pending
+def claim_next_request(req, host, board):
     req_data_dir = req.config.data_dir + os.sep + "requests"
+    where, args = where_clause({"host": host, "board": board,
+        "state": "pending"})
+
+    # the catalog lock is held while claiming, so each request is only
+    # given to one lab
+    db = open_catalog(req)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute("SELECT request_id FROM requests" + where +
+            " ORDER BY request_time, request_id", args).fetchall()
+        for row in rows:
+            request_id = row["request_id"]
+            filepath = req_data_dir + os.sep + request_id + ".json"
+
+            # skip a request that is being updated by someone else
+            # (waiting for it, while holding the catalog lock, could
+            # deadlock with the update)
+            try:
+                lock = object_lock(req, filepath, blocking=False)
+                lock.__enter__()
+            except IOError:
+                continue
+
+            try:
+                req_dict = catalog_get_request(req, request_id, db)
+                if req_dict is None or req_dict.get("state") != "pending":
+                    continue
+
+                fields = {"state": "running",
+                    "start_time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "revision": next_revision(req_dict)}
+                req_dict.update(fields)
+                journal_request(req, "claim", request_id, fields)
+                catalog_put_request(req, request_id, req_dict, db)
+
+                # commit before releasing the request lock, so the next
+                # update of the request sees the claim
+                db.execute("COMMIT")
+                return request_id, req_dict
+            finally:
+                lock.__exit__(None, None, None)
+
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+    return None, None
+
+# return True if this server can handle requests that wait for a long
+# time (get_next_request and watch).  In a pool of single-threaded
+# worker processes (e.g. test-server.py -w without -c), each waiting
+# request would take a whole worker away from other clients.  A web
+# server that runs one CGI script at a time (test-server.py with neither
+# option) sets FSERVER_NO_WAIT in the environment, since a waiting
+# request would hold up the whole server.
+def can_wait(req):
+    env = req.environ
+    if env.get("FSERVER_NO_WAIT"):
+        return False
+    if env.get("wsgi.multiprocess") and not env.get("wsgi.multithread") \
+            and not env.get("wsgi.run_once"):
+        return False
+    return True
+
+# return the oldest pending request for a host and board, and mark it
+# as running.  host and board may use wildcards (see item_match).
+# If no request is pending, wait up to 'timeout' seconds for one (up to
+# config.next_request_max_wait, and not at all if the server can't wait,
+# see can_wait).  If there is still none, return an empty response.
+def do_get_next_request(req):
+    msg = ""
+
+    try:
+        host = req.form["host"].value
+        board = req.form["board"].value
+    except:
+        msg += "Error: missing host or board in form data"
+        send_response("FAIL", msg)
+
+    try:
+        timeout = float(req.form.getfirst("timeout", "0"))
+    except ValueError:
+        msg += "Error: invalid timeout '%s'" % req.form.getfirst("timeout")
+        send_response("FAIL", msg)
+    timeout = max(min(timeout, req.config.next_request_max_wait), 0)
+    if not can_wait(req):
+        timeout = 0
+
+    end_time = time.time() + timeout
+    while True:
+        request_id, req_dict = claim_next_request(req, host, board)
+        if request_id:
+            break
+
+        remaining = end_time - time.time()
+        if remaining <= 0:
+            send_response("OK", "")
+
+        # wait for a new request in this process, or check again after
+        # the poll interval (for requests put by other processes)
+        with new_request_condition:
+            new_request_condition.wait(min(remaining,
+                req.config.next_request_poll_interval))
+
+    import json
+    req_dict["request_id"] = request_id
+    data = json.dumps(req_dict, sort_keys=True, indent=4, separators=(',', ': '))
+    send_response("OK", data)
+
+# the object types that can be watched
+watch_objects = ["request", "run", "test", "binary_package", "board"]
+
+# the id of a journal position, for a Server-Sent Event
+def journal_event_id(position):
+    return "%s:%d" % (position[0][len("journal-"):-len(".jsonl")], position[1])
+
+# returns the journal position for an event id, or None if it is invalid
+def parse_journal_event_id(event_id):
+    m = re.match(r"^(\d{4}-\d\d-\d\d):(\d+)$", event_id)
+    if not m:
+        return None
+    return ("journal-%s.jsonl" % m.group(1), int(m.group(2)))
+
+# stream changes to objects, as Server-Sent Events (text/event-stream)
+# Each event has the object type as its name, the journal entry for the
+# change (in json) as its data, and the journal position as its id.
+# 'objects' is an optional comma-separated list of the object types to
+# send.  A client that reconnects (with a Last-Event-ID header, or a
+# last_event_id parameter) gets the changes made since that event.
+def do_watch(req):
+    import json
+    objects = watch_objects
+    if req.form.has_key("objects"):
+        objects = req.form["objects"].value.split(",")
+        for object_type in objects:
+            if object_type not in watch_objects:
+                msg = "Error: can't watch objects of type '%s'" % object_type
+                send_response("FAIL", msg)
+
+    if not can_wait(req):
+        msg = "Error: watch is not supported by this server (it needs a " + \
+            "threaded server, such as test-server.py with -c)"
+        send_response("FAIL", msg)
+
+    last_event_id = req.environ.get("HTTP_LAST_EVENT_ID", "")
+    if req.form.has_key("last_event_id"):
+        last_event_id = req.form["last_event_id"].value
+    position = None
+    if last_event_id:
+        position = parse_journal_event_id(last_event_id)
+    if not position:
+        # only send changes from now on
+        position = get_journal_end(req)
+
+    sys.stdout.write("Content-type: text/event-stream\n")
+    sys.stdout.write("Cache-Control: no-cache\n\n")
+
+    end_time = time.time() + req.config.watch_max_time
+    last_send = 0
+    try:
+        while True:
+            for entry, position in read_journal(req, position):
+                if entry.get("object", "request") not in objects:
+                    continue
+                sys.stdout.write("id: %s\nevent: %s\ndata: %s\n\n" % \
+                    (journal_event_id(position),
+                    entry.get("object", "request"),
+                    json.dumps(entry, sort_keys=True)))
+                last_send = time.time()
+
+            now = time.time()
+            if now >= end_time:
+                break
+            if now - last_send >= req.config.watch_heartbeat_interval:
+                sys.stdout.write(": heartbeat\n\n")
+                last_send = now
+            sys.stdout.flush()
+
+            with journal_condition:
+                journal_condition.wait(min(end_time - now,
+                    req.config.watch_poll_interval))
+    except IOError:
+        # the client went away
+        pass
+
+    sys.exit(0)
+
+def do_get_request(req):
     msg = ""
 
     # handle host and target-based queries
@@ -1062,20 +2730,20 @@ def do_get_request(req):
         msg += "Error: can't read request_id from form"
         send_response("FAIL", msg)
 
-    filename = request_id + ".json"
-    filepath = req_data_dir + os.sep + filename
-    if not os.path.exists(filepath):
-        msg += "Error: filepath %s does not exist" % filepath
+    mydict = catalog_get_request(req, request_id)
+    if mydict is None:
+        msg += "Error: request %s does not exist" % request_id
         send_response("FAIL", msg)
 
-    # read requested file
+    # don't send the data again, if the client has it
+    # (the revision changes whenever the request is changed)
+    headers = check_not_modified(req, '"r%d"' % mydict.get("revision", 0))
+
     import json
-    request_fd = open(filepath, "r")
-    mydict = json.load(request_fd)
 
     # beautify the data, for now
     data = json.dumps(mydict, sort_keys=True, indent=4, separators=(',', ': '))
-    send_response("OK", data)
+    send_response("OK", data, headers)
 
 # return the url to download a run package
 def do_get_run_url(req):
@@ -1098,6 +2766,225 @@ def do_get_run_url(req):
     msg += run_file_url
     send_response("OK", msg)
 
+# return the SHA-256 digest and size of an uploaded package
+# the package is specified with one of: run_id, test or binary_package
+def do_get_digest(req):
+    msg = ""
+
+    if req.form.has_key("run_id"):
+        subdir = "runs"
+        name = req.form["run_id"].value
+    elif req.form.has_key("test"):
+        subdir = "tests"
+        name = req.form["test"].value
+    elif req.form.has_key("binary_package"):
+        subdir = "binary-packages"
+        name = req.form["binary_package"].value
+    else:
+        msg += "Error: missing run_id, test or binary_package in form"
+        send_response("FAIL", msg)
+
+    if "/" in name or name.startswith("."):
+        msg += "Error: invalid name '%s'" % name
+        send_response("FAIL", msg)
+
+    digest_path = req.config.data_dir + os.sep + subdir + os.sep + \
+        name + ".sha256"
+    sha256, filename = read_digest_file(digest_path)
+    if not sha256:
+        msg += "Error: no digest recorded for %s" % name
+        send_response("FAIL", msg)
+
+    filepath = req.config.files_dir + os.sep + subdir + os.sep + filename
+    try:
+        size = os.path.getsize(filepath)
+    except OSError:
+        msg += "Error: filepath %s does not exist" % filepath
+        send_response("FAIL", msg)
+
+    msg += "sha256=%s\n" % sha256
+    msg += "size=%d\n" % size
+    msg += "file=%s" % filename
+    send_response("OK", msg)
+
+# send a file as the response, with a content type based on its name
+# offset and size select part of the file (such as a member of a run
+# package), and name is used for the content type in that case.
+# headers is a list of (name, value) for additional response headers.
+def send_file(filepath, offset=0, size=None, name=None, headers=None):
+    import mimetypes
+    if size is None:
+        size = os.path.getsize(filepath) - offset
+    mime_type = mimetypes.guess_type(name or filepath)[0] or "text/plain"
+    sys.stdout.write("Content-type: %s\n" % mime_type)
+    for header in headers or []:
+        sys.stdout.write("%s: %s\n" % header)
+    sys.stdout.write("Content-Length: %d\n\n" % size)
+    fin = open(filepath, "rb")
+    fin.seek(offset)
+    while size > 0:
+        chunk = fin.read(min(size, 65536))
+        if not chunk:
+            break
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+        size -= len(chunk)
+    fin.close()
+    sys.exit(0)
+
+# return the offset of the start of the last 'lines' lines of a file
+# (the file data is at 'base' in filepath, with the given size)
+def tail_offset(filepath, base, size, lines):
+    fin = open(filepath, "rb")
+    count = 0
+    pos = size
+    try:
+        while pos > 0:
+            start = max(pos - 8192, 0)
+            fin.seek(base + start)
+            data = fin.read(pos - start)
+            i = len(data)
+            while True:
+                i = data.rfind("\n", 0, i)
+                if i < 0:
+                    break
+                # a newline at the end of the file doesn't start a line
+                if start + i == size - 1:
+                    continue
+                count += 1
+                if count == lines:
+                    return start + i + 1
+            pos = start
+    finally:
+        fin.close()
+    return 0
+
+# send (part of) a file from a run
+# The file data is at 'base' in filepath, with the given size.  The
+# 'offset' and 'length' fields of the form select a byte range (a
+# negative offset is from the end of the file), and 'tail_lines' selects
+# the last lines of the file.
+def send_run_file(req, filepath, base, size, name):
+    try:
+        offset = int(req.form.getfirst("offset", "0"))
+        length = int(req.form.getfirst("length", "-1"))
+        tail_lines = int(req.form.getfirst("tail_lines", "0"))
+    except ValueError:
+        send_response("FAIL", "Error: invalid offset, length or tail_lines")
+
+    if offset < 0:
+        offset = max(size + offset, 0)
+    offset = min(offset, size)
+    if tail_lines > 0:
+        offset = tail_offset(filepath, base, size, tail_lines)
+
+    part_size = size - offset
+    if length >= 0:
+        part_size = min(part_size, length)
+
+    # let the client know where the data is, for reading more later
+    headers = [("X-File-Size", str(size)), ("X-File-Offset", str(offset))]
+    send_file(filepath, base + offset, part_size, name, headers)
+
+# return the (name, is_dir) entries in a directory of a run, from the
+# run member index
+def run_member_children(db, run_id, path):
+    if path:
+        prefix = path + "/"
+        rows = db.execute("SELECT path, type FROM run_members WHERE run_id=? AND path > ? AND path < ?",
+            (run_id, prefix, path + "0"))
+    else:
+        prefix = ""
+        rows = db.execute("SELECT path, type FROM run_members WHERE run_id=? AND path != ''",
+            (run_id,))
+
+    children = {}
+    for row in rows:
+        rest = row["path"][len(prefix):]
+        name = rest.split("/")[0]
+        children[name] = children.get(name) or "/" in rest or row["type"] == "d"
+    return sorted(children.items())
+
+# show links to the files in a directory of a run
+# entries is a list of (name, is_dir)
+def show_run_dir(req, run_id, path, entries):
+    import urllib
+    req.show_header("Files for %s" % run_id)
+    file_url = config.url_base + "?action=get_run_file&run_id=%s&file=" % \
+        urllib.quote(run_id)
+    print("<ul>")
+    if path:
+        parent = os.path.dirname(path)
+        print('<li><a href="%s%s">../</a></li>' % (file_url, urllib.quote(parent)))
+    for f, is_dir in entries:
+        item_path = (path + "/" + f).lstrip("/")
+        if is_dir:
+            f += "/"
+        print('<li><a href="%s%s">%s</a></li>' % (file_url,
+            urllib.quote(item_path), cgi.escape(f)))
+    print("</ul>")
+
+# return a file from a run
+# If the run package is indexed, the file is read directly from the
+# package.  Otherwise, the run package is extracted (if needed).
+# if 'file' is missing, or is a directory, show a list of its files
+# (see send_run_file for the fields that select part of a file)
+def do_get_run_file(req):
+    msg = ""
+
+    try:
+        run_id = req.form["run_id"].value
+    except:
+        msg += "Error: can't read run_id from form"
+        send_response("FAIL", msg)
+
+    if not run_id.startswith("run-") or "/" in run_id:
+        msg += "Error: invalid run_id '%s'" % run_id
+        send_response("FAIL", msg)
+
+    # make the path relative to the run directory, with no '..'
+    path = os.path.normpath("/" + req.form.getfirst("file", "")).lstrip("/")
+
+    frp_path = req.config.files_dir + os.sep + "runs" + os.sep + run_id + ".frp"
+    db = open_catalog(req)
+    indexed = db.execute("SELECT 1 FROM run_members WHERE run_id=? LIMIT 1",
+        (run_id,)).fetchone()
+    if indexed and os.path.exists(frp_path):
+        row = db.execute("SELECT * FROM run_members WHERE run_id=? AND path=?",
+            (run_id, path)).fetchone()
+        if row and row["type"] == "f":
+            send_run_file(req, frp_path, row["offset"], row["size"], path)
+
+        if not row or row["type"] == "d":
+            entries = run_member_children(db, run_id, path)
+            if not entries and path:
+                msg += "Error: file %s not found in %s" % (path, run_id)
+                send_response("FAIL", msg)
+            show_run_dir(req, run_id, path, entries)
+            return
+
+        # other types of files (like links) are read from the
+        # extracted run directory
+
+    error, run_dir_path = get_run_dir(req, run_id)
+    if error:
+        send_response("FAIL", msg+error)
+
+    filepath = run_dir_path
+    if path:
+        filepath += os.sep + path
+    if os.path.isdir(filepath):
+        entries = [(f, os.path.isdir(filepath + os.sep + f))
+            for f in sorted(os.listdir(filepath))]
+        show_run_dir(req, run_id, path, entries)
+        return
+
+    if not os.path.isfile(filepath):
+        msg += "Error: file %s not found in %s" % (path, run_id)
+        send_response("FAIL", msg)
+
+    send_run_file(req, filepath, 0, os.path.getsize(filepath), path)
+
 def do_remove_request(req):
     req_data_dir = req.config.data_dir + os.sep + "requests"
     msg = ""
@@ -1110,14 +2997,27 @@ def do_remove_request(req):
 
     filename = request_id + ".json"
     filepath = req_data_dir + os.sep + filename
-    if not os.path.exists(filepath):
-        msg += "Error: filepath %s does not exist\n" % filepath
-        send_response("FAIL", msg)
 
     # FIXTHIS - should check permissions here
     # only original-submitter and requested-host are allowed to remove
 
-    os.remove(filepath)
+    with object_lock(req, filepath):
+        req_dict = catalog_get_request(req, request_id)
+        if req_dict is None:
+            msg += "Error: request %s does not exist\n" % request_id
+            send_response("FAIL", msg)
+
+        error = check_update_conditions(req, req_dict)
+        if error:
+            send_response("FAIL", msg+error)
+
+        journal_request(req, "remove", request_id)
+        catalog_remove_request(req, request_id)
+
+        # remove the request file now (it would be removed when the
+        # journal is compacted)
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
     # can remove os.path.basename() to debug
     msg += "Request file %s was removed\n" % os.path.basename(filepath)
@@ -1147,6 +3047,12 @@ def do_remove_run(req):
         result = "FAIL"
 
     msg += "Run file %s was removed\n" % os.path.basename(json_path)
+    catalog_remove_run(req, run_id)
+    journal_object(req, "remove", "run", run_id)
+
+    digest_path = run_data_dir + os.sep + run_id + ".sha256"
+    if os.path.exists(digest_path):
+        os.remove(digest_path)
 
     # remove .frp file
     frp_path = run_file_dir + os.sep + run_id + ".frp"
@@ -1162,16 +3068,15 @@ def do_remove_run(req):
 
     msg += "Run file %s was removed\n" % os.path.basename(frp_path)
 
-    # remove extracted run data
+    # remove extracted run data (if the run was ever extracted)
     run_dir_path = run_file_dir + os.sep + run_id[4:]
-    try:
-        import shutil
-        shutil.rmtree(run_dir_path)
-    except:
-        msg += "Error: could not remove %s\n" % run_dir_path
-        result = "FAIL"
-
-    msg += "Run directory %s was removed\n" % os.path.basename(run_dir_path)
+    if os.path.isdir(run_dir_path):
+        try:
+            remove_run_dir(req, run_id)
+            msg += "Run directory %s was removed\n" % os.path.basename(run_dir_path)
+        except:
+            msg += "Error: could not remove %s\n" % run_dir_path
+            result = "FAIL"
 
     send_response(result, msg)
 
@@ -1205,112 +3110,178 @@ def file_list_html(req, file_type, subdir, extension):
     html += "</ul>"
     return html
 
+# convert a request start_time to a datetime
+# returns None if the start_time can't be parsed
+def parse_start_time(start_time):
+    # remove timezone suffix
+    # timezone ending is '+HHMM' or '-HHMM'
+    # FIXTHIS - should not throw away the timezone information
+    if start_time[-5:-4] in ["+", "-"]:
+        start_time = start_time[:-5]
+
+    try:
+        return datetime.datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+# return the time limit (in hours) for a request to complete
+def get_request_timeout(req, req_dict):
+    hours = req.config.request_timeout_hours
+
+    board_filename = "board-%s:%s.json" % (req_dict.get("host", ""),
+            req_dict.get("board", ""))
+    board_path = req.config.data_dir + os.sep + "boards" + os.sep + board_filename
+    try:
+        board_dict = read_json_file(board_path)
+        hours = float(board_dict["request_timeout_hours"])
+    except:
+        pass
+
+    test_name = req_dict.get("test_name", "")
+    for pattern, test_hours in req.config.test_request_timeout_hours.items():
+        if item_match(pattern, test_name):
+            hours = test_hours
+
+    return hours
+
+# return the time at which a request times out (in the format of
+# start_time, without a timezone), or None if the request can't time out.
+# An empty string is returned if the request is running, but its
+# start_time can't be parsed (so that it is handled immediately)
+def request_deadline(req, req_dict):
+    if req_dict.get("state", "") != "running":
+        return None
+
+    start_time = req_dict.get("start_time", "unknown")
+    if start_time == "unknown":
+        return None
+
+    dt_start_time = parse_start_time(start_time)
+    if not dt_start_time:
+        return ""
+
+    hours = get_request_timeout(req, req_dict)
+    deadline = dt_start_time + datetime.timedelta(hours=hours)
+    return deadline.strftime("%Y-%m-%dT%H:%M:%S")
+
 def timeout_requests(req):
     #req.add_to_message('in timeout_requests()')
     #log_this("in timeout_requests()")
     src_dir = req.config.data_dir + os.sep + "requests"
 
-    full_dirlist = os.listdir(src_dir)
-
-    # filter list to only request....json files, and create
-    # full filenames
-    filelist = []
-    for f in full_dirlist:
-        if f.startswith("request") and f.endswith(".json"):
-            filelist.append(src_dir + "/" + f)
-
-    import json
+    # running requests are indexed in the catalog by their deadline,
+    # so only the requests that have expired need to be read
+    db = open_catalog(req)
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    rows = db.execute("SELECT request_id FROM requests WHERE deadline < ? ORDER BY deadline",
+            (now,)).fetchall()
 
-    now = datetime.datetime.now()
-    for filepath in filelist:
-        update_request = False
+    for row in rows:
+        request_id = row["request_id"]
+        filepath = src_dir + os.sep + request_id + ".json"
 
-        # read request data
-        try:
-            request_fd = open(filepath, "r")
-        except:
-            continue
+        with object_lock(req, filepath):
+            req_dict = catalog_get_request(req, request_id)
+            if req_dict is None:
+                continue
 
-        req_dict = json.load(request_fd)
-        request_fd.close()
+            # check the deadline again, in case the request was just
+            # updated (or the board's time limit was changed)
+            deadline = request_deadline(req, req_dict)
+            if deadline is None or deadline >= now:
+                catalog_put_request(req, request_id, req_dict)
+                continue
 
-        try:
             start_time = req_dict["start_time"]
-        except:
-            start_time = "unknown"
-
-        if req_dict["state"] == "running" and start_time != "unknown":
-            # remove timezone suffix
-            # timezone ending is '+HHMM' or '-HHMM'
-            # FIXTHIS - should not throw away the timezone information
-            if start_time[-5] in ["+", "-"]:
-                start_time = start_time[:-5]
-
+            fields = {"state": "error"}
+            if not deadline:
+                fields["reason"] = "Could not parse start_time of %s" % start_time
+            else:
+                # expire a request when its time limit is reached
+                hours = get_request_timeout(req, req_dict)
+                fields["reason"] = "Request timed out. Test was not completed within %g hours of starting (at %s)." % (hours, start_time)
+                fields["done_time"] = get_timestamp()
+            fields["revision"] = next_revision(req_dict)
+            req_dict.update(fields)
+
+            journal_request(req, "timeout", request_id, fields)
+            catalog_put_request(req, request_id, req_dict)
+
+def start_timeout_ticker():
+    # check for request timeouts, and compact the request journal,
+    # periodically, in a background thread
+    def ticker():
+        ticker_req = req_class(config)
+        last_compact = time.time()
+        while True:
+            time.sleep(config.timeout_check_interval)
             try:
-                dt_start_time = datetime.datetime.strptime(start_time,
-                        "%Y-%m-%dT%H:%M:%S")
+                timeout_requests(ticker_req)
             except:
-                update_request = True
-                req_dict["state"] = "error"
-                req_dict["reason"] = "Could not parse start_time of %s" % start_time
-                dt_start_time = now   # prevent timeout
-
-            # expire a request 12 hours after it was started
-            # this is arbitrary
-            if now > dt_start_time + datetime.timedelta(hours=12):
-                update_request = True
-                req_dict["state"] = "error"
-                req_dict["reason"] = "Request timed out. Test was not completed within 12 hours of starting (at %s)." % start_time
-                req_dict["done_time"] = get_timestamp()
-
-        if update_request:
-            # put dictionary back in json format (beautified)
-            data = json.dumps(req_dict, sort_keys=True, indent=4, separators=(',', ': '))
-            fout = open(filepath, "w")
-            fout.write(data+'\n')
-            fout.close()
+                import traceback
+                log_this("Exception in timeout_requests:\n" + traceback.format_exc())
 
+            if time.time() - last_compact < config.journal_compact_interval:
+                continue
+            last_compact = time.time()
+            try:
+                compact_journal(ticker_req)
+            except:
+                import traceback
+                log_this("Exception in compact_journal:\n" + traceback.format_exc())
+
+    thread = threading.Thread(target=ticker)
+    thread.daemon = True
+    thread.start()
+
+# The object tables (requests and runs) can be paged, sorted and
+# filtered, with the following query string parameters:
+#  page_size = number of rows per page (0 = all)
+#  offset = number of rows to skip (the start of the page)
+#  sort = column to sort by, and order = 'asc' or 'desc'
+#  filters = state, host, board, test, and others (depending on the table)
+#    (filter values may use '*' wildcards at the start or end)
+# The table rows are read from the catalog, with the paging, sorting
+# and filtering done in the database query.
+
+# (heading, column) for request table columns
+request_table_columns = [("Request", "request_id"), ("State", "state"),
+        ("Requestor", "requestor"), ("Host", "host"), ("Board", "board"),
+        ("Test", "test_name"), ("Run (results)", None), ("Action links", None)]
+
+# filter names for the request table, and their catalog columns
+request_table_filters = [("state", "state"), ("requestor", "requestor"),
+        ("host", "host"), ("board", "board"), ("test", "test_name")]
 
 def show_request_table(req):
-    # check for request timeouts
-    timeout_requests(req)
-
-    src_dir = req.config.data_dir + os.sep + "requests"
-
-    full_dirlist = os.listdir(src_dir)
-    full_dirlist.sort()
-
-    # filter list to only request....json files
-    filelist = []
-    for f in full_dirlist:
-        if f.startswith("request") and f.endswith(".json"):
-            filelist.append(f)
+    import json
+    params = get_table_params(req, request_table_columns,
+            request_table_filters, "request_id")
+    db = open_catalog(req)
+    where, args = where_clause(params["patterns"])
+    total = db.execute("SELECT COUNT(*) FROM requests" + where, args).fetchone()[0]
+
+    print(table_controls_html(req, params, request_table_filters, total))
+    if not total:
+        if params["patterns"]:
+            print(req.html_error("No matching requests found."))
+        else:
+            print(req.html_error("No request files found."))
+        return
 
-    if not filelist:
-        return req.html_error("No request files found.")
+    rows = db.execute("SELECT request_id, data FROM requests" + where +
+            table_order_sql(params, "request_id"), args)
 
-    files_url = config.files_url_base + "/data/requests/"
-    run_files_url = config.files_url_base + "/files/runs/"
+    # the request files are only updated when the journal is compacted,
+    # so link to the current data
+    request_url = config.url_base + "?action=get_request&request_id="
+    run_files_url = config.url_base + "?action=get_run_file&run_id=run-"
     del_url = config.url_base + "?action=remove_request&request_id="
-    html = """<table border="1" cellpadding="2">
-  <tr>
-    <th>Request</th>
-    <th>State</th>
-    <th>Requestor</th>
-    <th>Host</th>
-    <th>Board</th>
-    <th>Test</th>
-    <th>Run (results)</th>
-    <th>Action links</th>
-  </tr>
-"""
-    import json
-    for item in filelist:
-        # request_id is filename minus the .json suffix
-        request_id = item[:-5]
-        request_fd = open(src_dir+os.sep + item, "r")
-        req_dict = json.load(request_fd)
-        request_fd.close()
+    sys.stdout.write(table_header_html(req, params, request_table_columns))
+    for row in rows:
+        request_id = row["request_id"]
+        item = request_id + ".json"
+        req_dict = json.loads(row["data"])
 
         # add data, in case it's missing
         try:
@@ -1318,132 +3289,229 @@ def show_request_table(req):
         except:
             req_dict["run_id"] = "Not available"
 
-        html += '  <tr>\n'
-        html += '    <td><a href="'+files_url+item+'">' + item + '</a></td>\n'
+        cells = ['    <td><a href="'+request_url+request_id+'">' + item + '</a></td>\n']
         for attr in ["state", "requestor", "host", "board", "test_name",
                 "run_id"]:
             if attr == "run_id":
                 if req_dict["state"] == "done":
-                    # create a link to the run directory, if present
+                    # create a link to the run files, if present
                     run_id = req_dict["run_id"]
-                    run_dir = run_id
-                    if os.path.isdir(config.files_dir + "/runs/" + run_dir):
-                        html += '    <td><a href="'+run_files_url+run_dir+'">'+run_id+'</a></td>\n'
+                    if os.path.exists(config.files_dir + "/runs/run-" + run_id + ".frp"):
+                        cells.append('    <td><a href="'+run_files_url+run_id+'">'+run_id+'</a></td>\n')
                         continue
                 if req_dict["state"] == "error":
                     try:
-                        html += '    <td><font color="red">'+req_dict["reason"]+'</font></td>\n'
+                        cells.append('    <td><font color="red">'+req_dict["reason"]+'</font></td>\n')
                         continue
                     except:
                         pass
 
             # show just the attribute
-            html += '    <td>%s</td>\n' % req_dict[attr]
+            cells.append('    <td>%s</td>\n' % req_dict[attr])
 
         # add a 'delete' link
-        html += '    <td><a href="' + del_url + request_id + '">Delete request</a></td>\n'
+        cells.append('    <td><a href="' + del_url + request_id + '">Delete request</a></td>\n')
 
-        html += '  </tr>\n'
-    html += "</table>"
-    print(html)
+        write_table_row(req, cells)
 
-def show_run_table(req):
-    src_dir = req.config.data_dir + os.sep + "runs"
+    print("</table>")
 
-    full_dirlist = os.listdir(src_dir)
-    full_dirlist.sort()
+# (heading, column) for run table columns
+run_table_columns = [("Run Id", "run_id"), ("Test", "name"),
+        ("Spec", "test_spec"), ("Host", "host_name"), ("Board", "board"),
+        ("Timestamp", "timestamp"), ("Result", "status"),
+        ("Run File bundle", None), ("Action links", None)]
 
-    # filter list to only run....json files
-    filelist = []
-    for f in full_dirlist:
-        if f.startswith("run-") and f.endswith(".json"):
-            filelist.append(f)
+# filter names for the run table, and their catalog columns
+run_table_filters = [("state", "status"), ("host", "host_name"),
+        ("board", "board"), ("test", "name"), ("spec", "test_spec")]
 
-    if not filelist:
-        return req.html_error("No request files found.")
+def show_run_table(req):
+    params = get_table_params(req, run_table_columns, run_table_filters,
+            "run_id")
+    db = open_catalog(req)
+    where, args = where_clause(params["patterns"])
+    total = db.execute("SELECT COUNT(*) FROM runs" + where, args).fetchone()[0]
+
+    print(table_controls_html(req, params, run_table_filters, total))
+    if not total:
+        if params["patterns"]:
+            print(req.html_error("No matching runs found."))
+        else:
+            print(req.html_error("No run files found."))
+        return
+
+    rows = db.execute("SELECT * FROM runs" + where +
+            table_order_sql(params, "run_id"), args)
 
     data_url = config.files_url_base + "/data/runs/"
     files_url = config.files_url_base + "/files/runs/"
+    run_files_url = config.url_base + "?action=get_run_file&run_id="
     del_url = config.url_base + "?action=remove_run&run_id="
-    html = """<table border="1" cellpadding="2">
-  <tr>
-    <th>Run Id</th>
-    <th>Test</th>
-    <th>Spec</th>
-    <th>Host</th>
-    <th>Board</th>
-    <th>Timestamp</th>
-    <th>Result</th>
-    <th>Run File bundle</th>
-    <th>Action links</th>
-  </tr>
-"""
-    import json
-    for item in filelist:
-        # run_id is the filename with ".json" removed
-        run_id = item[:-5]
-        # run_dir is the run_id with "run-" removed
-        run_dir = run_id[4:]
-
-        run_filepath = src_dir + os.sep + item
-        file_read_error = False
-        file_data_error = False
-        try:
-            run_fd = open(run_filepath, "r")
-            run_dict = json.load(run_fd)
-            run_fd.close()
+    sys.stdout.write(table_header_html(req, params, run_table_columns))
+    for row in rows:
+        run_id = row["run_id"]
+        item = run_id + ".json"
+
+        if row["error"]:
+            cells = ['    <td>'+run_id+'</td>\n',
+                '    <td colspan="7">\n<font color="red">',
+                row["error"],
+                ' error on server for this run %s</font></td>\n']
+        else:
+            filename = run_id + ".frp"
+            cells = ['    <td><a href="'+run_files_url+run_id+'">'+run_id+'</a></td>\n',
+                '    <td>%s</td>\n' % row["name"],
+                '    <td>%s</td>\n' % row["test_spec"],
+                '    <td>%s</td>\n' % row["host_name"],
+                '    <td>%s</td>\n' % row["board"],
+                '    <td>%s</td>\n' % row["timestamp"],
+                '    <td><a href="'+data_url+item+'">' + row["status"] + '</a></td>\n',
+                '    <td><a href="'+files_url+filename+'">frp file</a></td>\n']
+        cells.append('    <td><a href="'+del_url+run_id+'">Delete run</a></td>\n')
 
-        except IOError:
-            file_read_error = True
+        write_table_row(req, cells)
 
-        if "name" in run_dict:
-            name = run_dict["name"]
-        elif "test_name" in run_dict:
-            # this is here because older versions of the Fuego core
-            # created a pre-run run.json file with 'test_name' instead
-            # of 'name'.
-            name = run_dict["test_name"]
-        else:
-            # well, this shouldn't happen
-            # but report it anyway
-            name = "<i>data error</i>"
-            file_data_error = True
+    print("</table>")
 
-        try:
-            test_spec = run_dict["metadata"]["test_spec"]
-            host_name = run_dict["metadata"]["host_name"]
-            board = run_dict["metadata"]["board"]
-            status = run_dict["status"]
-            timestamp = run_dict["metadata"]["timestamp"]
-        except KeyError:
-            file_data_error = True
-
-        html += '  <tr>\n'
-        if file_read_error or file_data_error:
-            html += '    <td>'+run_id+'</td>\n'
-            html += '    <td colspan="7">\n<font color="red">'
-            if file_read_error:
-                html += "Read"
+# get table paging, sorting and filtering parameters from the form
+def get_table_params(req, columns, filters, default_sort):
+    params = {}
+
+    try:
+        page_size = int(req.form.getfirst("page_size", ""))
+    except ValueError:
+        page_size = req.config.table_page_size
+    params["page_size"] = max(page_size, 0)
+
+    try:
+        offset = int(req.form.getfirst("offset", ""))
+    except ValueError:
+        offset = 0
+    params["offset"] = max(offset, 0)
+
+    sort = req.form.getfirst("sort", default_sort)
+    if sort not in [column for heading, column in columns if column]:
+        sort = default_sort
+    params["sort"] = sort
+
+    if req.form.getfirst("order", "") == "desc":
+        params["order"] = "desc"
+    else:
+        params["order"] = "asc"
+
+    # filter values, by filter name and by catalog column
+    params["filters"] = {}
+    params["patterns"] = {}
+    for name, column in filters:
+        value = req.form.getfirst(name, "")
+        if value:
+            params["filters"][name] = value
+            params["patterns"][column] = value
+
+    return params
+
+def table_order_sql(params, key):
+    sql = " ORDER BY %s %s" % (params["sort"], params["order"].upper())
+    if params["sort"] != key:
+        sql += ", %s %s" % (key, params["order"].upper())
+    if params["page_size"]:
+        sql += " LIMIT %d OFFSET %d" % (params["page_size"], params["offset"])
+    return sql
+
+# return the url for the current table page, with some parameters changed
+def table_url(req, params, **changes):
+    import urllib
+    query = {"page_size": params["page_size"], "offset": params["offset"],
+            "sort": params["sort"], "order": params["order"]}
+    query.update(params["filters"])
+    query.update(changes)
+    return req.page_url + "?" + req.html_escape(urllib.urlencode(sorted(query.items())))
+
+# return html for the table filter form, and page navigation links
+def table_controls_html(req, params, filters, total):
+    html = '<form method="get" action="%s">\n' % req.page_url
+    for name, column in filters:
+        value = params["filters"].get(name, "")
+        html += '%s: <input type="text" name="%s" value="%s" size="12">\n' % \
+            (name.capitalize(), name, req.html_escape(value).replace('"', "&quot;"))
+    html += 'Page size: <input type="text" name="page_size" value="%d" size="4">\n' % params["page_size"]
+    html += '<input type="hidden" name="sort" value="%s">\n' % params["sort"]
+    html += '<input type="hidden" name="order" value="%s">\n' % params["order"]
+    html += '<input type="submit" value="Show">\n</form>\n'
+
+    page_size = params["page_size"]
+    offset = params["offset"]
+    if not page_size or not total:
+        html += "<p>Showing %d items</p>\n" % total
+        return html
+
+    last = min(offset + page_size, total)
+    html += "<p>Showing items %d-%d of %d" % (offset + 1, last, total)
+    if offset > 0:
+        html += ' | <a href="%s">First page</a>' % table_url(req, params, offset=0)
+        html += ' | <a href="%s">Previous page</a>' % \
+            table_url(req, params, offset=max(offset - page_size, 0))
+    if last < total:
+        html += ' | <a href="%s">Next page</a>' % \
+            table_url(req, params, offset=last)
+        html += ' | <a href="%s">Last page</a>' % \
+            table_url(req, params, offset=((total - 1) // page_size) * page_size)
+    html += "</p>\n"
+    return html
+
+# return html for the start of a table, with links to sort by each column
+def table_header_html(req, params, columns):
+    html = '<table border="1" cellpadding="2">\n  <tr>\n'
+    for heading, column in columns:
+        if not column:
+            html += '    <th>%s</th>\n' % heading
+            continue
+        order = "asc"
+        if column == params["sort"]:
+            if params["order"] == "asc":
+                heading += " &#9650;"
+                order = "desc"
             else:
-                html += "Data"
-            html += ' error on server for this run %s</font></td>\n'
-        else:
-            html += '    <td><a href="'+files_url+run_dir+'">'+run_id+'</a></td>\n'
-            html += '    <td>%s</td>\n' % name
-            html += '    <td>%s</td>\n' % test_spec
-            html += '    <td>%s</td>\n' % host_name
-            html += '    <td>%s</td>\n' % board
-            html += '    <td>%s</td>\n' % timestamp
-            html += '    <td><a href="'+data_url+item+'">' + status + '</a></td>\n'
-            filename = item[:-4]+"frp"
-            html += '    <td><a href="'+files_url+filename+'">frp file</a></td>\n'
-        html += '    <td><a href="'+del_url+run_id+'">Delete run</a></td>\n'
-        html += '  </tr>\n'
-    html += "</table>"
-    print(html)
+                heading += " &#9660;"
+        url = table_url(req, params, sort=column, order=order, offset=0)
+        html += '    <th><a href="%s">%s</a></th>\n' % (url, heading)
+    html += '  </tr>\n'
+    return html
 
+# output a table row
+# Rows are written as they are produced, and the output is flushed
+# periodically, so the start of a large table is sent to the client
+# without waiting for the rest of it.
+def write_table_row(req, cells):
+    sys.stdout.write('  <tr>\n' + "".join(cells) + '  </tr>\n')
+    req.table_rows += 1
+    if req.table_rows % req.config.table_flush_rows == 0:
+        sys.stdout.flush()
+
+
+# return an ETag for the current contents of a show page
+# Object tables are generated from the catalog, and change when its
+# generation changes.  Lists of files change when their directories
+# change.  The page also depends on the fserver code.
+def show_page_etag(req):
+    tag = "%x" % int(os.path.getmtime(os.path.abspath(__file__)))
+    if req.page_name in ["requests", "runs"]:
+        tag += "-g%x" % catalog_generation(req)
+    elif req.page_name in ["binary-packages", "boards", "tests"]:
+        for base_dir in [req.config.data_dir, req.config.files_dir]:
+            path = base_dir + os.sep + req.page_name
+            if os.path.isdir(path):
+                tag += "-%x" % int(os.path.getmtime(path) * 1000000)
+    return '"%s"' % tag
 
 def do_show(req):
+    # check for request timeouts first, so that requests that just timed
+    # out change the page's ETag
+    if req.page_name == "requests":
+        timeout_requests(req)
+
+    req.headers = check_not_modified(req, show_page_etag(req))
     req.show_header("Fuego server objects")
     log_this("in do_show, req.page_name='%s'\n" % req.page_name)
     #print("req.page_name='%s' <br><br>" % req.page_name)
@@ -1507,9 +3575,12 @@ def old_do_show(req):
         page_data = "page filename %s not found" % page_filename
     return
 
+# actions that receive a file, using save_file()
+upload_actions = ["put_test", "put_run", "put_binary_package"]
+
 def main(req):
     # parse request
-    query_string = get_env("QUERY_STRING")
+    query_string = req.environ.get("QUERY_STRING", "")
 
     # determine action, if any
     query_parts = query_string.split("&")
@@ -1521,7 +3592,7 @@ def main(req):
     #req.add_to_message('action="%s"<br>' % action)
 
     # get page name
-    page_name = get_env("PATH_INFO")
+    page_name = req.environ.get("PATH_INFO", "")
     if not page_name:
         page_name = "/main"
     page_name = os.path.basename(page_name)
@@ -1535,16 +3606,17 @@ def main(req):
     #req.show_header('Debug')
     #show_env(os.environ)
     if debug:
-        remote_addr = os.environ.get("REMOTE_ADDR", "unknown")
-        content_length = os.environ.get("CONTENT_LENGTH", "unknown")
-        content_type = os.environ.get("CONTENT_TYPE", "unknown")
+        remote_addr = req.environ.get("REMOTE_ADDR", "unknown")
+        content_length = req.environ.get("CONTENT_LENGTH", "unknown")
+        content_type = req.environ.get("CONTENT_TYPE", "unknown")
         log_this("DEBUG: REMOTE_ADDR=%s, CONTENT_LENGTH=%s, CONTENT_TYPE=%s" %
                 (remote_addr, content_length, content_type))
         log_this("DEBUG: in main(), request loop: action='%s'" % action)
 
     # perform action
-    if action != "put_run":
-        req.form = cgi.FieldStorage()
+    # (upload actions read their form while saving the uploaded file)
+    if action not in upload_actions:
+        req.form = cgi.FieldStorage(fp=req.input, environ=req.environ)
 
     if debug:
         log_this("DEBUG: in main(), after call to cgi.FieldStorage")
@@ -1553,7 +3625,10 @@ def main(req):
             "put_binary_package", "put_board", "update_board", "get_board",
             "query_boards", "query_requests", "query_runs", "query_tests",
             "query_binary_tests",
-            "get_request", "get_run_url", "get_test",
+            "get_request", "get_request_history", "get_next_request",
+            "get_run_url", "watch",
+            "get_run_file", "get_test",
+            "get_digest",
             "remove_request", "remove_test", "remove_run",
             "update_request"]
 
@@ -1575,9 +3650,7 @@ def main(req):
     print(req.html_error("Unknown action '%s'" % action))
 
 
-req = req_class(config)
-
-if __name__=="__main__":
+def handle_request(req):
     try:
         main(req)
         req.show_message()
@@ -1593,3 +3666,401 @@ if __name__=="__main__":
         traceback.print_exception(etype, evalue, etb, None, sys.stdout)
         print "</pre>"
 
+#######################
+# response compression
+#
+# The output of an action (CGI-style, with a header block) is passed
+# through compressed_output, which compresses the body if the client
+# accepts it (with the Accept-Encoding header), and it is text of at
+# least config.compress_min_bytes.  Streamed output (such as a large
+# object table) is compressed as it is flushed.
+
+# content types which are compressed
+compress_types = ["text/html", "text/plain", "text/css", "text/xml",
+        "application/json", "application/javascript", "application/x-yaml"]
+
+# return the content encoding to use for a response ("gzip", "deflate"
+# or ""), given the Accept-Encoding header of the request
+def choose_encoding(accept_encoding):
+    accepted = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, sep, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+
+    for coding in ["gzip", "deflate"]:
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return ""
+
+class compressed_output:
+    """Compress CGI-style output, if the client accepts it.
+
+    Output is held until the header block, and enough of the body to
+    decide whether to compress it, has been written.  After that, the
+    output is passed to 'out', either unchanged or compressed.
+    """
+    def __init__(self, out, environ):
+        self.out = out
+        self.encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        self.buffer = []
+        self.size = 0
+        self.compressor = None
+        self.passthrough = not self.encoding
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if self.passthrough:
+            self.out.write(data)
+        elif self.compressor:
+            self.out.write(self.compressor.compress(data))
+        else:
+            self.buffer.append(data)
+            self.size += len(data)
+            if self.size >= config.compress_min_bytes + 4096:
+                self.start(False)
+
+    def flush(self):
+        if not self.passthrough and not self.compressor:
+            # more output is expected, so compress even a short body
+            self.start(True, streaming=True)
+        if self.compressor:
+            import zlib
+            self.out.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.out.flush()
+
+    def close(self):
+        if not self.passthrough and not self.compressor:
+            self.start(True)
+        if self.compressor:
+            self.out.write(self.compressor.flush())
+            self.compressor = None
+
+    def start(self, finished, streaming=False):
+        # decide whether to compress the output, and start sending it
+        # if finished is False, more output may be needed to decide
+        import zlib
+        output = "".join(self.buffer)
+        if not re.search(r"\r?\n\r?\n", output):
+            if not finished:
+                return
+            self.send_unchanged(output)
+            return
+
+        status, headers, body = parse_cgi_output(output)
+        content_type = ""
+        for name, value in headers:
+            if name.lower() == "content-type":
+                content_type = value.split(";")[0].strip().lower()
+            if name.lower() == "content-encoding":
+                content_type = ""
+        if content_type not in compress_types or status[:3] in ["204", "304"]:
+            self.send_unchanged(output)
+            return
+
+        if len(body) < config.compress_min_bytes and not streaming:
+            if not finished:
+                return
+            headers.append(("Vary", "Accept-Encoding"))
+            self.send_unchanged(self.header_block(status, headers) + body)
+            return
+
+        new_headers = []
+        for name, value in headers:
+            if name.lower() == "content-length":
+                continue
+            if name.lower() == "etag" and not value.startswith("W/"):
+                # the compressed data is not byte-for-byte the same
+                value = "W/" + value
+            new_headers.append((name, value))
+        new_headers.append(("Content-Encoding", self.encoding))
+        new_headers.append(("Vary", "Accept-Encoding"))
+
+        if self.encoding == "gzip":
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+        self.compressor = zlib.compressobj(config.compress_level,
+            zlib.DEFLATED, wbits)
+        self.buffer = []
+        self.out.write(self.header_block(status, new_headers))
+        self.out.write(self.compressor.compress(body))
+
+    def send_unchanged(self, output):
+        self.passthrough = True
+        self.buffer = []
+        self.out.write(output)
+
+    def header_block(self, status, headers):
+        block = ""
+        if status != "200 OK":
+            block += "Status: %s\n" % status
+        for header in headers:
+            block += "%s: %s\n" % header
+        return block + "\n"
+
+#######################
+# persistent server support
+#
+# Running fserver.py as a CGI script costs an interpreter startup, plus
+# module imports, for every request.  To avoid this, fserver can also be
+# run inside a long-lived process, as a WSGI application (wsgi_app), or
+# using the built-in server (fserver.py --serve [<port>]).
+#
+# The action code writes its output with print and sys.stdout.write, as
+# in CGI mode.  In persistent mode, that output is redirected (per-thread)
+# to a buffer, and converted into a WSGI response.
+
+class stdout_router:
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def target(self):
+        target = getattr(self.local, "target", None)
+        if target is None:
+            return self.default
+        return target
+
+    def capture(self, target):
+        self.local.target = target
+
+    def release(self):
+        self.local.target = None
+
+    def write(self, data):
+        # data read from json files is unicode
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+router_lock = threading.Lock()
+
+def get_stdout_router():
+    with router_lock:
+        if not isinstance(sys.stdout, stdout_router):
+            sys.stdout = stdout_router(sys.stdout)
+    return sys.stdout
+
+# convert CGI script output to a (status, headers, body) tuple
+def parse_cgi_output(output):
+    status = "200 OK"
+    headers = []
+
+    # header block is terminated by the first empty line
+    m = re.match(r"(.*?)\r?\n\r?\n", output, re.S)
+    if not m:
+        return status, [("Content-type", "text/html")], output
+
+    body = output[m.end():]
+    for line in m.group(1).splitlines():
+        if ":" not in line:
+            continue
+        name, value = line.split(":", 1)
+        name = name.strip()
+        value = value.strip()
+        if name.lower() == "status":
+            status = value
+        else:
+            headers.append((name, value))
+
+    return status, headers, body
+
+class wsgi_output:
+    """Collect CGI-style output, and pass it to a WSGI server.
+
+    Output is normally buffered, and returned as a single response
+    body (with a Content-Length) when the request is finished.  If the
+    output is flushed, the response is started, and the output so far
+    is passed to the server (using the WSGI write callable).
+    """
+    def __init__(self, start_response):
+        self.start_response = start_response
+        self.buffer = []
+        self.write_body = None
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def flush(self):
+        output = "".join(self.buffer)
+        if not self.write_body:
+            # wait for the complete header block
+            if not re.search(r"\r?\n\r?\n", output):
+                return
+            status, headers, output = parse_cgi_output(output)
+            self.write_body = self.start_response(status, headers)
+
+        self.buffer = []
+        if output:
+            self.write_body(output)
+
+    def finish(self):
+        output = "".join(self.buffer)
+        self.buffer = []
+        if self.write_body:
+            if output:
+                self.write_body(output)
+            return []
+
+        status, headers, body = parse_cgi_output(output)
+        headers = [(name, value) for name, value in headers
+            if name.lower() != "content-length"]
+        if not status.startswith("304"):
+            headers.append(("Content-Length", str(len(body))))
+        self.start_response(status, headers)
+        return [body]
+
+def wsgi_app(environ, start_response):
+    req = req_class(config)
+    req.environ = environ
+    req.input = environ["wsgi.input"]
+
+    out = wsgi_output(start_response)
+    compressor = compressed_output(out, environ)
+    router = get_stdout_router()
+    router.capture(compressor)
+    try:
+        handle_request(req)
+        compressor.close()
+    finally:
+        router.release()
+
+    return out.finish()
+
+def serve(port):
+    from wsgiref import simple_server
+    import SocketServer
+
+    class fserver_wsgi_server(SocketServer.ThreadingMixIn,
+            simple_server.WSGIServer):
+        daemon_threads = True
+
+    httpd = simple_server.make_server("", port, wsgi_app,
+            server_class=fserver_wsgi_server)
+    start_timeout_ticker()
+    print "Serving fserver on port %d (url %s)" % (port, config.url_base)
+    httpd.serve_forever()
+
+# compute the SHA-256 digest of a file
+def file_sha256(filepath):
+    import hashlib
+    sha = hashlib.sha256()
+    fin = open(filepath, "rb")
+    while 1:
+        chunk = fin.read(1048576)
+        if not chunk:
+            break
+        sha.update(chunk)
+    fin.close()
+    return sha.hexdigest()
+
+# move existing test and binary packages into the blob store, and
+# remove blobs that are no longer used by any package
+def dedup_packages(req):
+    import shutil
+    saved = 0
+    linked = 0
+    for subdir, ext in [("tests", ".ftp"), ("binary-packages", ".ftbp")]:
+        pkg_dir = req.config.files_dir + os.sep + subdir
+        for f in sorted(os.listdir(pkg_dir)):
+            if not f.endswith(ext):
+                continue
+            filepath = pkg_dir + os.sep + f
+            blob_path = store_blob(req, filepath, file_sha256(filepath))
+            if os.path.samefile(filepath, blob_path):
+                continue
+
+            # replace the file with a link to the blob
+            saved += os.path.getsize(filepath)
+            linked += 1
+            # (the link is made in a new temporary directory, since
+            # os.link can't replace a file)
+            tempdir = tempfile.mkdtemp(dir=pkg_dir, prefix=".dedup-")
+            try:
+                os.link(blob_path, tempdir + os.sep + f)
+                os.rename(tempdir + os.sep + f, filepath)
+            finally:
+                shutil.rmtree(tempdir, ignore_errors=True)
+            print "Linked %s/%s to %s" % (subdir, f, os.path.basename(blob_path))
+
+    removed = 0
+    blob_dir = req.config.files_dir + os.sep + "blobs"
+    if os.path.isdir(blob_dir):
+        for d in sorted(os.listdir(blob_dir)):
+            for f in sorted(os.listdir(blob_dir + os.sep + d)):
+                blob_path = blob_dir + os.sep + d + os.sep + f
+                if os.stat(blob_path).st_nlink == 1:
+                    saved += os.path.getsize(blob_path)
+                    removed += 1
+                    os.remove(blob_path)
+            if not os.listdir(blob_dir + os.sep + d):
+                os.rmdir(blob_dir + os.sep + d)
+
+    print "Linked %d duplicate packages, removed %d unused blobs (%d bytes freed)" % (linked, removed, saved)
+
+def usage():
+    print """Usage: fserver.py [--serve [<port>]]
+
+When run with no arguments (normally by a web server, as a CGI script),
+handle a single request described by the CGI environment.
+
+Options:
+ --serve [<port>]   Run fserver as a persistent server, handling requests
+                    in-process.  The default port is 8000.
+ --rebuild-catalog  Rebuild the catalog (index) of object data, from the
+                    files in the data directory.
+ --dedup-packages   Store existing test and binary packages in the blob
+                    store (files/blobs), linking identical packages to a
+                    single copy, and remove unused blobs.
+ --compact-journal  Bring the request files up to date with the request
+                    journal (data/journal).
+"""
+
+req = req_class(config)
+
+if __name__=="__main__":
+    # handle command line arguments, when not running as a CGI script
+    if not os.environ.get("GATEWAY_INTERFACE") and len(sys.argv) > 1:
+        if sys.argv[1] in ["-h", "--help"]:
+            usage()
+            sys.exit(0)
+
+        if sys.argv[1] == "--serve":
+            port = 8000
+            if len(sys.argv) > 2:
+                port = int(sys.argv[2])
+            serve(port)
+            sys.exit(0)
+
+        if sys.argv[1] == "--rebuild-catalog":
+            rebuild_catalog(req, open_catalog(req), force=True)
+            print "Rebuilt catalog %s" % config.catalog_path
+            sys.exit(0)
+
+        if sys.argv[1] == "--dedup-packages":
+            dedup_packages(req)
+            sys.exit(0)
+
+        if sys.argv[1] == "--compact-journal":
+            count = compact_journal(req)
+            print "Compacted journal, updating %d request files" % count
+            sys.exit(0)
+
+    out = compressed_output(sys.stdout, os.environ)
+    sys.stdout = out
+    handle_request(req)
+    out.close()
@@ -20,18 +20,130 @@ __version__ = "0.4"
 
 __all__ = ["CGIHTTPRequestHandler"]
 
-import os, sys, urllib, select
+import os, sys, urllib, select, signal
 import re
+import errno
+import socket
+import threading
+import SocketServer
 import BaseHTTPServer
 import SimpleHTTPServer
 import CGIHTTPServer
 from urlparse import urlparse
 
 
+def load_sendfile():
+    """Return the sendfile() function from the C library, or None.
+
+    Python 2 has no os.sendfile, so it is called using ctypes.  The
+    Linux calling convention is assumed, so other systems use None
+    (a normal copy through user space).
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+            use_errno=True)
+        func = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+libc_sendfile = load_sendfile()
+
+def sendfile(sock, in_fd, offset, count):
+    """Send count bytes of in_fd, starting at offset, to a socket.
+
+    The data is copied by the kernel, without passing through Python.
+    Return the number of bytes sent, which is less than count if the
+    file is shorter than expected, or if sendfile isn't usable for this
+    file (in which case the caller should copy the rest itself).
+    """
+    if not libc_sendfile:
+        return 0
+
+    import ctypes
+    out_fd = sock.fileno()
+    timeout = sock.gettimeout()
+    pos = ctypes.c_int64(offset)
+    sent = 0
+    while sent < count:
+        n = libc_sendfile(out_fd, in_fd, ctypes.byref(pos),
+            min(count - sent, 0x40000000))
+        if n > 0:
+            sent += n
+            continue
+        if n == 0:
+            break
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err == errno.EAGAIN:
+            # sockets with a timeout are non-blocking
+            r, w, x = select.select([], [out_fd], [], timeout)
+            if not w:
+                raise socket.timeout("timed out")
+            continue
+        if err in (errno.EINVAL, errno.ENOSYS) and not sent:
+            # not supported for this file
+            break
+        raise socket.error(err, os.strerror(err))
+    return sent
+
+
+class RequestBody:
+    """File-like object for reading the body of a request.
+
+    Reads are limited to the Content-Length of the request, so that
+    the application can't read into the next (pipelined) request on a
+    persistent connection.
+    """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ""
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        """Discard any part of the body the application didn't read."""
+        while self.read(65536):
+            pass
+
+
 class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
     """CGIHTTPServer doesn't handle CGI scripts for do_GET
     (What's up with that?)
     """
+    # if set, fserver.py is run in-process, using this module
+    fserver_module = None
+
+    # responses are written in several small pieces (status line and
+    # headers, body chunks, and the chunk terminator).  Send them right
+    # away, instead of waiting for the client to acknowledge the previous
+    # piece, which takes up to 40ms on a kept-alive connection.
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         """Serve a GET request."""
         if self.is_cgi():
@@ -43,6 +155,177 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             if f:
                 self.copyfile(f, self.wfile)
                 f.close()
+            else:
+                # redirects are sent without a Content-Length
+                self.close_connection = 1
+
+    def send_head(self):
+        """Common code for GET and HEAD commands.
+
+        Regular files are sent with Content-Length, Last-Modified and
+        ETag headers.  A single byte range ("Range: bytes=<start>-<end>",
+        with either part optional) is honored, with a 206 (Partial
+        Content) response.  If a file has an up-to-date compressed copy
+        (<file>.gz), that is sent to clients that accept gzip encoding.
+        Directories are handled as by SimpleHTTPRequestHandler.
+        """
+        self.range_length = None
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+        ctype = self.guess_type(path)
+        encoding = None
+        gz_path = path + ".gz"
+        has_gz = os.path.isfile(gz_path) and \
+            os.path.getmtime(gz_path) >= os.path.getmtime(path)
+        if has_gz and not self.headers.getheader("range") and \
+                self.accepts_gzip():
+            path = gz_path
+            encoding = "gzip"
+
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, "File not found")
+            return None
+
+        fs = os.fstat(f.fileno())
+        size = fs.st_size
+        start, end = 0, size - 1
+        # use sub-second mtime, so a file rewritten within a second
+        # (with the same size) gets a new ETag
+        etag = '"%x-%x"' % (int(fs.st_mtime * 1000000), size)
+
+        if self.not_modified(etag, fs.st_mtime):
+            f.close()
+            self.send_response(304, "Not Modified")
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        byte_range = None
+        range_header = self.headers.getheader("range")
+        if range_header:
+            byte_range = self.parse_range(range_header, size)
+        if byte_range is False:
+            f.close()
+            self.send_response(416, "Requested Range Not Satisfiable")
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        if byte_range:
+            start, end = byte_range
+            f.seek(start)
+            self.send_response(206, "Partial Content")
+            self.send_header("Content-Range",
+                "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.range_length = end - start + 1
+        self.send_header("Content-type", ctype)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if has_gz:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(self.range_length))
+        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return f
+
+    def accepts_gzip(self):
+        """Check whether the client accepts gzip content encoding."""
+        accept = self.headers.getheader("accept-encoding") or ""
+        for item in accept.split(","):
+            parts = item.strip().split(";")
+            if parts[0].strip().lower() not in ("gzip", "*"):
+                continue
+            for param in parts[1:]:
+                name, sep, value = param.strip().partition("=")
+                if name.strip() == "q" and value.strip() in ("0", "0.0", "0.00", "0.000"):
+                    return False
+            return True
+        return False
+
+    def not_modified(self, etag, mtime):
+        """Check whether the client already has this version of a file.
+
+        This uses the If-None-Match header, or (if that is missing)
+        the If-Modified-Since header.
+        """
+        if_none_match = self.headers.getheader("if-none-match")
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return etag in tags or "W/" + etag in tags or "*" in tags
+
+        if_modified_since = self.headers.getheader("if-modified-since")
+        if if_modified_since:
+            import email.utils
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def parse_range(self, range_header, size):
+        """Parse a Range header, for a file of the given size.
+
+        Return (start, end) (inclusive) for a single byte range, False
+        if the range can't be satisfied, or None if the header is not
+        a single byte range.
+        """
+        m = re.match(r"bytes=(\d*)-(\d*)$", range_header.strip())
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+
+        if m.group(1):
+            start = int(m.group(1))
+            end = size - 1
+            if m.group(2):
+                if int(m.group(2)) < start:
+                    return None
+                end = min(int(m.group(2)), size - 1)
+        else:
+            # suffix range: the last N bytes
+            length = int(m.group(2))
+            if not length:
+                return False
+            start = max(size - length, 0)
+            end = size - 1
+
+        if start >= size:
+            return False
+        return start, end
+
+    def copyfile(self, source, outputfile):
+        """Copy the file (or the requested range of it) to the client.
+
+        Files are sent with sendfile, when possible.
+        """
+        if self.range_length is None:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self,
+                source, outputfile)
+
+        remaining = self.range_length
+        if outputfile is self.wfile:
+            outputfile.flush()
+            offset = source.tell()
+            sent = sendfile(self.connection, source.fileno(), offset,
+                remaining)
+            remaining -= sent
+            if remaining:
+                source.seek(offset + sent)
+
+        while remaining > 0:
+            buf = source.read(min(remaining, 65536))
+            if not buf:
+                break
+            outputfile.write(buf)
+            remaining -= len(buf)
+
     def is_cgi(self):
         cgi_directories = ['/cgi-bin', '/htbin']
 
@@ -98,47 +381,11 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         #self.log_message("extension=%s" % tail.lower())
         return tail.lower() in (".py", ".pyw")
 
-    def run_cgi(self):
-        """Execute a CGI script."""
-        dir, rest = self.cgi_info
-        i = rest.rfind('?')
-        if i >= 0:
-            # strip off query
-            rest, query = rest[:i], rest[i+1:]
-        else:
-            query = ''
-        i = rest.find('/')
-        if i >= 0:
-            script, rest = rest[:i], rest[i:]
-        else:
-            script, rest = rest, ''
-
-        scriptname = script
-        scriptfile = self.translate_path(scriptname)
-        parts = urlparse(self.path)
-        self.log_message("scriptfile=%s" % scriptfile)
-        if not os.path.exists(scriptfile):
-            self.send_error(404, "No such CGI script (%s)" % `scriptname`)
-            return
-        if not os.path.isfile(scriptfile):
-            self.send_error(403, "CGI script is not a plain file (%s)" %
-                            `scriptname`)
-            return
-        ispy = self.is_python(scriptname)
-        self.log_message("ispy=%s" % ispy)
-
-        if not ispy:
-            if not (self.have_fork or self.have_popen2 or self.have_popen3):
-                self.send_error(403, "CGI script is not a Python script (%s)" %
-                                `scriptname`)
-                return
-            if not self.is_executable(scriptfile):
-                self.send_error(403, "CGI script is not executable (%s)" %
-                                `scriptname`)
-                return
-
+    def cgi_environ(self, scriptname):
+        """Return the CGI environment for a request."""
         # Reference: http://hoohoo.ncsa.uiuc.edu/cgi/env.html
         # XXX Much of the following could be prepared ahead of time!
+        parts = urlparse(self.path)
         env = {}
         env['SERVER_SOFTWARE'] = self.version_string()
         env['SERVER_NAME'] = self.server.server_name
@@ -179,15 +426,171 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         co = filter(None, self.headers.getheaders('cookie'))
         if co:
             env['HTTP_COOKIE'] = ', '.join(co)
-        # XXX Other HTTP_* headers
+        # other HTTP_* headers (such as If-None-Match)
+        for name in self.headers.keys():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in env and key not in ('HTTP_CONTENT_TYPE',
+                    'HTTP_CONTENT_LENGTH'):
+                env[key] = ', '.join(self.headers.getheaders(name))
         # Since we're setting the env in the parent, provide empty
         # values to override previously set values
         for k in ('QUERY_STRING', 'REMOTE_HOST', 'CONTENT_LENGTH',
                   'HTTP_USER_AGENT', 'HTTP_COOKIE'):
             env.setdefault(k, "")
-        os.environ.update(env)
+        return env
+
+    def run_fserver(self, env):
+        """Run fserver in this process, using its WSGI interface."""
+        env['wsgi.version'] = (1, 0)
+        env['wsgi.url_scheme'] = 'http'
+        try:
+            length = int(env['CONTENT_LENGTH'])
+        except ValueError:
+            length = 0
+        body_input = RequestBody(self.rfile, length)
+        env['wsgi.input'] = body_input
+        env['wsgi.errors'] = sys.stderr
+        env['wsgi.multithread'] = isinstance(self.server,
+            SocketServer.ThreadingMixIn)
+        env['wsgi.multiprocess'] = True
+        env['wsgi.run_once'] = False
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return write
+
+        def send_headers():
+            code, message = response['status'].split(" ", 1)
+            self.send_response(int(code), message)
+            has_length = False
+            for name, value in response['headers']:
+                self.send_header(name, value)
+                if name.lower() == "content-length":
+                    has_length = True
+            if not has_length and code not in ("204", "304"):
+                # stream the response, in chunks if possible
+                if self.request_version >= "HTTP/1.1" and \
+                        self.protocol_version >= "HTTP/1.1":
+                    self.send_header("Transfer-Encoding", "chunked")
+                    response['chunked'] = True
+                else:
+                    self.close_connection = 1
+            self.end_headers()
+            response['headers_sent'] = True
+
+        def write(data):
+            if not response.get('headers_sent'):
+                send_headers()
+            if not data:
+                return
+            if response.get('chunked'):
+                self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+            self.wfile.flush()
+
+        body = self.fserver_module.wsgi_app(env, start_response)
+        body_input.drain()
+        for data in body:
+            write(data)
+        if not response.get('headers_sent'):
+            send_headers()
+        if response.get('chunked'):
+            self.wfile.write("0\r\n\r\n")
+
+    def send_cgi_output(self, fd):
+        """Send the output of a CGI script, read from fd.
+
+        The response status is taken from the script's Status header,
+        if it has one (as a web server such as Apache does), and is
+        200 otherwise.
+        """
+        data = ""
+        end = None
+        while end is None:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+            end = re.search(r"\r?\n\r?\n", data)
+
+        code, message = 200, "Script output follows"
+        if end:
+            lines = data[:end.start()].split("\n")
+            for line in lines:
+                name, sep, value = line.partition(":")
+                if name.strip().lower() == "status":
+                    status = value.strip().split(None, 1)
+                    try:
+                        code = int(status[0])
+                    except (IndexError, ValueError):
+                        break
+                    message = status[1:] and status[1] or ""
+                    lines.remove(line)
+                    data = "".join([l + "\n" for l in lines]) + \
+                        data[end.start():].lstrip("\r")[1:]
+                    break
+
+        self.send_response(code, message)
+        # the length of the script output is not known, so a
+        # persistent connection can't be used
+        if self.protocol_version >= "HTTP/1.1":
+            self.send_header("Connection", "close")
+        while data:
+            self.wfile.write(data)
+            data = os.read(fd, 65536)
+
+    def run_cgi(self):
+        """Execute a CGI script."""
+        dir, rest = self.cgi_info
+        i = rest.rfind('?')
+        if i >= 0:
+            # strip off query
+            rest, query = rest[:i], rest[i+1:]
+        else:
+            query = ''
+        i = rest.find('/')
+        if i >= 0:
+            script, rest = rest[:i], rest[i:]
+        else:
+            script, rest = rest, ''
+
+        scriptname = script
+        scriptfile = self.translate_path(scriptname)
+        parts = urlparse(self.path)
+        self.log_message("scriptfile=%s" % scriptfile)
+        if not os.path.exists(scriptfile):
+            self.send_error(404, "No such CGI script (%s)" % `scriptname`)
+            return
+        if not os.path.isfile(scriptfile):
+            self.send_error(403, "CGI script is not a plain file (%s)" %
+                            `scriptname`)
+            return
+        ispy = self.is_python(scriptname)
+        self.log_message("ispy=%s" % ispy)
 
-        self.send_response(200, "Script output follows")
+        if not ispy:
+            if not (self.have_fork or self.have_popen2 or self.have_popen3):
+                self.send_error(403, "CGI script is not a Python script (%s)" %
+                                `scriptname`)
+                return
+            if not self.is_executable(scriptfile):
+                self.send_error(403, "CGI script is not executable (%s)" %
+                                `scriptname`)
+                return
+
+        env = self.cgi_environ(scriptname)
+        if self.fserver_module and scriptname == "fserver.py":
+            self.run_fserver(env)
+            return
+
+        # scripts are run one at a time, so tell fserver not to wait
+        # for long (for get_next_request or watch)
+        env['FSERVER_NO_WAIT'] = '1'
+        length = env['CONTENT_LENGTH']
+        os.environ.update(env)
 
         decoded_query = query.replace('+', ' ')
 
@@ -199,10 +602,20 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
 	    # FIXTHIS - should setuid to reduce security risk!!
             #nobody = nobody_uid()
             self.wfile.flush() # Always flush before forking
+            # the script output is read through a pipe, to get the
+            # response status from its headers
+            out_fd, script_fd = os.pipe()
             pid = os.fork()
             if pid != 0:
                 # Parent
-                pid, sts = os.waitpid(pid, 0)
+                os.close(script_fd)
+                try:
+                    self.send_cgi_output(out_fd)
+                finally:
+                    # (closing the pipe ends the script, if the client
+                    # went away)
+                    os.close(out_fd)
+                    pid, sts = os.waitpid(pid, 0)
                 # throw away additional data [see bug #427345]
                 while select.select([self.rfile], [], [], 0)[0]:
                     if not self.rfile.read(1):
@@ -218,7 +631,9 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                 #except os.error:
                 #    pass
                 os.dup2(self.rfile.fileno(), 0)
-                os.dup2(self.wfile.fileno(), 1)
+                os.dup2(script_fd, 1)
+                os.close(out_fd)
+                os.close(script_fd)
                 self.log_message("scriptfile: %s", scriptfile)
                 os.execve(scriptfile, args, os.environ)
             except:
@@ -259,7 +674,7 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                 if not self.rfile._sock.recv(1):
                     break
             fi.close()
-            shutil.copyfileobj(fo, self.wfile)
+            self.send_cgi_output(fo.fileno())
             if self.have_popen3:
                 errors = fe.read()
                 fe.close()
@@ -273,6 +688,10 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
 
         else:
             # Other O.S. -- execute script in this process
+            # (the script's Status header is not used)
+            self.send_response(200, "Script output follows")
+            if self.protocol_version >= "HTTP/1.1":
+                self.send_header("Connection", "close")
             save_argv = sys.argv
             save_stdin = sys.stdin
             save_stdout = sys.stdout
@@ -295,9 +714,161 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             else:
                 self.log_message("CGI script exited OK")
 
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    """HTTP server that handles each connection in a separate thread.
+
+    At most max_connections connections are handled at the same time.
+    Additional connections wait in the listen queue until a connection
+    is closed.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass,
+            max_connections=64):
+        self.max_connections = max_connections
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+            RequestHandlerClass)
+
+    def process_request(self, request, client_address):
+        self.connection_slots.acquire()
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                client_address)
+        except:
+            self.connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self,
+                request, client_address)
+        finally:
+            self.connection_slots.release()
+
+    def wait_idle(self):
+        """Wait for all connections to be closed."""
+        for i in range(self.max_connections):
+            self.connection_slots.acquire()
+
+def load_fserver(path="fserver.py"):
+    """Import fserver.py, so it can be run in-process."""
+    import imp
+    return imp.load_source("fserver", path)
+
+def prefork_serve(httpd, workers, max_requests, worker_init=None):
+    """Serve requests using a pool of pre-forked worker processes.
+
+    The workers all accept connections from the same listening socket.
+    A worker exits after handling max_requests requests (if non-zero),
+    and is replaced with a new one.  (For a threaded server, this is
+    the number of connections, each of which may carry many requests.)
+    If worker_init is given, it is called in each worker when it starts.
+    """
+    children = []
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid:
+            children.append(pid)
+            return
+        # Child
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            if worker_init:
+                worker_init()
+            handled = 0
+            while not max_requests or handled < max_requests:
+                httpd.handle_request()
+                handled += 1
+            if isinstance(httpd, ThreadedHTTPServer):
+                httpd.wait_idle()
+        except KeyboardInterrupt:
+            pass
+        os._exit(0)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    for i in range(workers):
+        spawn_worker()
+
+    try:
+        while True:
+            pid, sts = os.wait()
+            if pid in children:
+                children.remove(pid)
+                spawn_worker()
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
 def test(HandlerClass = fServerRequestHandler,
          ServerClass = BaseHTTPServer.HTTPServer):
-    SimpleHTTPServer.test(HandlerClass, ServerClass)
+    import argparse
+    parser = argparse.ArgumentParser(description="Test web server for fserver")
+    parser.add_argument("port", nargs="?", type=int, default=8000,
+        help="TCP/IP port for the server (default 8000)")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+        help="number of pre-forked worker processes.  If neither this "
+            "nor -c is specified, requests are handled one at a time, "
+            "with a new CGI process for each request")
+    parser.add_argument("-m", "--max-requests", type=int, default=1000,
+        help="number of requests handled by a worker before it is "
+            "replaced (0 means no limit, default 1000)")
+    parser.add_argument("-c", "--max-connections", type=int, default=0,
+        help="handle up to this many connections at the same time, "
+            "using threads, with HTTP/1.1 persistent connections "
+            "(per worker, if used with -w)")
+    parser.add_argument("-k", "--keepalive-timeout", type=int, default=15,
+        help="seconds to wait for the next request on a persistent "
+            "connection (default 15)")
+    args = parser.parse_args()
+
+    if not args.workers and not args.max_connections:
+        httpd = ServerClass(('', args.port), HandlerClass)
+        sa = httpd.socket.getsockname()
+        print "Serving HTTP on", sa[0], "port", sa[1], "..."
+        httpd.serve_forever()
+        return
+
+    # run fserver in-process
+    # (import it before forking, so workers start warm)
+    HandlerClass.fserver_module = load_fserver()
+    # the request body is read in-process, so buffered reads are OK
+    HandlerClass.rbufsize = -1
+
+    if args.max_connections:
+        HandlerClass.protocol_version = "HTTP/1.1"
+        HandlerClass.timeout = args.keepalive_timeout
+        httpd = ThreadedHTTPServer(('', args.port), HandlerClass,
+            args.max_connections)
+        mode = "up to %d connections" % args.max_connections
+    else:
+        httpd = ServerClass(('', args.port), HandlerClass)
+        mode = "one connection"
+    sa = httpd.socket.getsockname()
+
+    # fserver checks for request timeouts, and compacts the request
+    # journal, in a background thread.  Threads are not copied by fork,
+    # so with workers, each worker starts its own.
+    start_ticker = HandlerClass.fserver_module.start_timeout_ticker
+    if not args.workers:
+        print "Serving HTTP on", sa[0], "port", sa[1], \
+            "with %s at a time ..." % mode
+        start_ticker()
+        httpd.serve_forever()
+        return
+
+    print "Serving HTTP on", sa[0], "port", sa[1], \
+        "with %d worker processes (%s each) ..." % (args.workers, mode)
+    prefork_serve(httpd, args.workers, args.max_requests, start_ticker)
 
 
 if __name__ == '__main__':